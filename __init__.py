@@ -19,6 +19,7 @@ from party import Party, Address, ContactMechanism
 from product import Template, TemplatePrestashop, Product, ProductPrestashop
 from sale import Sale, SaleLine, SiteOrderState
 from lang import Language, SiteLanguage
+from job import ImportJob
 
 
 def register():
@@ -45,6 +46,7 @@ def register():
         Sale,
         SaleLine,
         SiteOrderState,
+        ImportJob,
         module='prestashop', type_='model')
     Pool.register(
         PrestashopExportOrdersWizard,
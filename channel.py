@@ -5,24 +5,40 @@
     :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
+import logging
+import threading
+import zlib
+from contextlib import contextmanager
 from datetime import datetime
+from functools import wraps
+from multiprocessing.pool import ThreadPool
 
 import pytz
 import requests
 import pystashop
 from mockstashop import MockstaShopWebservice
+from sql import Cast, Union
+from sql.operators import Concat
+from trytond import backend
 from trytond.model import ModelView, fields
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
 from trytond.wizard import Wizard, StateView, Button
 from trytond.pyson import Eval
 
+from webservice import (
+    RecordCache, using_record_cache, get_record_cache, get_client,
+    get_read_client, format_display
+)
+
 __metaclass__ = PoolMeta
 __all__ = [
     'Channel', 'PrestashopExportOrdersWizardView',
     'PrestashopExportOrdersWizard',
     'PrestashopConnectionWizardView', 'PrestashopConnectionWizard',
 ]
+logger = logging.getLogger('prestashop')
+
 TIMEZONES = [(None, '')] + [(x, x) for x in pytz.common_timezones]
 
 PRESTASHOP_STATES = {
@@ -33,6 +49,56 @@ INVISIBLE_IF_NOT_PRESTASHOP = {
     'invisible': ~(Eval('source') == 'prestashop')
 }
 
+#: Number of orders fetched per webservice call while importing orders
+DEFAULT_IMPORT_PAGE_SIZE = 100
+
+#: Number of orders imported between two checkpoints of an order import
+DEFAULT_CHECKPOINT_INTERVAL = 100
+
+#: Number of requests sent concurrently to prestashop while importing orders
+DEFAULT_MAX_CONNECTIONS = 4
+
+#: IDs on prestashop are unsigned 32 bit integers
+MAX_PRESTASHOP_ID = 4294967295
+
+#: Number of channels whose orders are imported in parallel by the cron
+IMPORT_WORKERS = 16
+
+#: Number of sales whose state is exported together, only the orders of one
+#: batch are held in memory at a time
+EXPORT_BATCH_SIZE = 100
+
+#: Number of queued orders retried together, the outcome of each batch is
+#: committed
+JOB_BATCH_SIZE = 20
+
+_import_locks_lock = threading.Lock()
+_import_locks = {}
+
+#: First key of the database advisory locks taken on prestashop channels,
+#: the second one being the ID of the channel
+ADVISORY_LOCK_KEY = zlib.crc32(b'prestashop.channel') & 0x7fffffff
+
+
+def with_prestashop_lock(func):
+    """Decorator for the methods of a prestashop channel which must not run
+    at the same time as another one on the same channel. The method is
+    skipped, returning an empty list, if the channel is already locked.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.source != 'prestashop':
+            return func(self, *args, **kwargs)
+        with self.prestashop_lock() as locked:
+            if not locked:
+                logger.info(
+                    'Channel %s is locked by another synchronisation, '
+                    'skipping %s', self.id, func.__name__
+                )
+                return []
+            return func(self, *args, **kwargs)
+    return wrapper
+
 
 class Channel:
     """
@@ -90,6 +156,73 @@ class Channel:
         depends=['source']
     )
 
+    #: The number of orders fetched from prestashop in one request while
+    #: importing orders. Only one page of orders is held in memory at a time.
+    prestashop_import_page_size = fields.Integer(
+        'Import Page Size', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source']
+    )
+
+    #: The number of orders imported after which the progress of an order
+    #: import is saved and committed
+    prestashop_checkpoint_interval = fields.Integer(
+        'Checkpoint Interval', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source']
+    )
+
+    #: The checkpoint of an interrupted order import. The time is the end of
+    #: the time window of the import, and the order is the last one imported
+    #: before the interruption. They are cleared once the import completes.
+    prestashop_checkpoint_time = fields.DateTime(
+        'Checkpoint Time', readonly=True, states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source']
+    )
+    prestashop_checkpoint_order_id = fields.Integer(
+        'Checkpoint Order ID', readonly=True,
+        states=INVISIBLE_IF_NOT_PRESTASHOP, depends=['source']
+    )
+    prestashop_checkpoint_date_upd = fields.DateTime(
+        'Checkpoint Order Update Time', readonly=True,
+        states=INVISIBLE_IF_NOT_PRESTASHOP, depends=['source']
+    )
+
+    #: The maximum number of requests sent concurrently to prestashop while
+    #: fetching the records needed to import a page of orders
+    prestashop_max_connections = fields.Integer(
+        'Max Concurrent Requests', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source']
+    )
+
+    #: The format in which the records are read from prestashop while
+    #: importing orders. JSON is lighter to parse, everything else always
+    #: uses XML.
+    prestashop_output_format = fields.Selection([
+        ('xml', 'XML'),
+        ('json', 'JSON'),
+    ], 'Import Output Format', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source']
+    )
+
+    @staticmethod
+    def default_prestashop_output_format():
+        "Return the default output format for imports"
+        return 'xml'
+
+    @staticmethod
+    def default_prestashop_max_connections():
+        "Return the default number of concurrent requests"
+        return DEFAULT_MAX_CONNECTIONS
+
+    @staticmethod
+    def default_prestashop_import_page_size():
+        "Return the default page size for order import"
+        return DEFAULT_IMPORT_PAGE_SIZE
+
+    @staticmethod
+    def default_prestashop_checkpoint_interval():
+        "Return the default number of orders between two checkpoints"
+        return DEFAULT_CHECKPOINT_INTERVAL
+
     @classmethod
     def get_source(cls):
         """
@@ -127,12 +260,15 @@ class Channel:
             'test_prestashop_connection': {},
             'import_prestashop_languages': {},
             'import_prestashop_order_states': {},
+            'import_prestashop_mappings': {},
             'export_prestashop_orders_button': {},
         })
 
     def get_prestashop_client(self):
         """
         Returns an authenticated instance of the Prestashop client
+        The client is reused across calls for the same channel, URL and key
+        so that the HTTP connections to the site are kept alive.
 
         :return: Prestashop client object
         """
@@ -142,8 +278,26 @@ class Channel:
         if Transaction().context.get('ps_test'):
             return MockstaShopWebservice('Some URL', 'A Key')
 
-        return pystashop.PrestaShopWebservice(
-            self.prestashop_url, self.prestashop_key
+        return get_client(self.id, self.prestashop_url, self.prestashop_key)
+
+    def get_prestashop_import_client(self):
+        """
+        Return the client used to read the records imported from prestashop,
+        as per the output format set on the channel. The XML client parses
+        lists as they are received, and the records read by the JSON client
+        have the same attributes as the objectified XML records, so the
+        `*_using_ps_data` methods work with both.
+
+        :returns: Prestashop client object
+        """
+        if Transaction().context.get('ps_test'):
+            return self.get_prestashop_client()
+
+        if not all([self.prestashop_url, self.prestashop_key]):
+            self.raise_user_error('prestashop_settings_missing')
+        return get_read_client(
+            self.id, self.prestashop_url, self.prestashop_key,
+            self.prestashop_output_format or 'xml'
         )
 
     @classmethod
@@ -220,6 +374,51 @@ class Channel:
 
         return new_records
 
+    @classmethod
+    @ModelView.button
+    def import_prestashop_mappings(cls, channels):
+        """Import all the countries, states and currencies from prestashop
+        and cache the corresponding tryton records, so that the import of
+        orders does not have to look them up on prestashop one by one.
+
+        Each resource is fetched in a single request.
+
+        :returns: List of cache records created
+        """
+        Country = Pool().get('country.country')
+        Subdivision = Pool().get('country.subdivision')
+        Currency = Pool().get('currency.currency')
+
+        if len(channels) != 1:
+            cls.raise_user_error('multiple_channels')
+        channel = channels[0]
+
+        channel.validate_prestashop_channel()
+
+        with Transaction().set_context(current_channel=channel.id):
+            client = channel.get_prestashop_client()
+            display = channel.get_prestashop_display_fields()
+
+            # Countries must be cached before the states as the code of a
+            # subdivision is prefixed with the code of its country
+            new_records = Country.cache_prestashop_records(
+                client.countries.get_list(
+                    display=format_display(display['countries'])
+                )
+            )
+            new_records.extend(Subdivision.cache_prestashop_records(
+                client.states.get_list(
+                    display=format_display(display['states'])
+                )
+            ))
+            new_records.extend(Currency.cache_prestashop_records(
+                client.currencies.get_list(
+                    display=format_display(display['currencies'])
+                )
+            ))
+
+        return new_records
+
     @classmethod
     @ModelView.button_action('prestashop.wizard_prestashop_connection')
     def test_prestashop_connection(cls, channels):
@@ -244,6 +443,7 @@ class Channel:
         ):
             cls.raise_user_error('wrong_url')
 
+    @with_prestashop_lock
     def import_orders(self):
         """
         Downstream implementation of channel.import_orders
@@ -251,6 +451,9 @@ class Channel:
         Import orders for the current prestashop channel
         Import only those orders which are updated after the
         `last prestashop order import time` as set in the prestashop channel
+        If the last import was interrupted, it is resumed from its checkpoint
+        Nothing is imported while the channel is locked by another
+        synchronisation
 
         :returns: The list of active records of sales imported
         """
@@ -258,46 +461,573 @@ class Channel:
             return super(Channel, self).import_orders()
 
         Sale = Pool().get('sale.sale')
+        ImportJob = Pool().get('prestashop.import.job')
+
         self.validate_prestashop_channel()
 
         if not self.prestashop_order_states:
             self.raise_user_error('order_states_not_imported')
 
+        # An interrupted import leaves a checkpoint behind. Resume it using the
+        # same time window so that the orders already imported are not
+        # downloaded again.
+        utc_time_now = self.prestashop_checkpoint_time or datetime.utcnow()
+
         # Localize to the site timezone
-        utc_time_now = datetime.utcnow()
         site_tz = pytz.timezone(self.prestashop_timezone)
         time_now = site_tz.normalize(pytz.utc.localize(utc_time_now))
-        client = self.get_prestashop_client()
+        client = self.get_prestashop_import_client()
 
         with Transaction().set_context(current_channel=self.id):
+            filters = {}
             if self.last_order_import_time:
                 # In tryton all time stored is in UTC
                 # Convert the last import time to timezone of the site
                 last_order_import_time = site_tz.normalize(
                     pytz.utc.localize(self.last_order_import_time)
                 )
-                orders_to_import = client.orders.get_list(
-                    filters={
-                        'date_upd': '{0},{1}'.format(
-                            last_order_import_time.strftime(
-                                '%Y-%m-%d %H:%M:%S'
-                            ),
-                            time_now.strftime('%Y-%m-%d %H:%M:%S')
-                        )
-                    }, date=1, display='full'
+                filters['date_upd'] = '{0},{1}'.format(
+                    last_order_import_time.strftime('%Y-%m-%d %H:%M:%S'),
+                    time_now.strftime('%Y-%m-%d %H:%M:%S')
                 )
-            else:
-                # FIXME: This wont scale if there are thousands of orders
-                orders_to_import = client.orders.get_list(display='full')
 
+            # Orders are imported in ascending order of ID, so everything
+            # upto the checkpoint has already been handled.
+            last_id = self.prestashop_checkpoint_order_id or 0
+            if not last_id:
+                self.write([self], {
+                    'prestashop_checkpoint_time': utc_time_now,
+                })
+
+            checkpoint_interval = self.prestashop_checkpoint_interval or \
+                DEFAULT_CHECKPOINT_INTERVAL
+            # There are only a handful of order states on a site, so they
+            # are looked up once for the whole import
+            order_states = dict(
+                (state.prestashop_id, state)
+                for state in self.prestashop_order_states
+            )
+            sales_imported = []
+            orders_handled = orders_checkpointed = 0
+            for orders in self.get_prestashop_order_pages(
+                client, filters, last_id
+            ):
+                new_orders, changed_sales = self.split_prestashop_orders(
+                    orders
+                )
+                sales_imported.extend(changed_sales)
+
+                record_cache = self.prefetch_prestashop_order_data(
+                    client, new_orders, order_states
+                )
+                with using_record_cache(record_cache):
+                    sales, failures = Sale.create_all_using_ps_data(
+                        new_orders
+                    )
+                del record_cache
+                sales_imported.extend(sales)
+
+                for order_id, exception in failures:
+                    logger.warning(
+                        'Order %s of channel %s could not be imported, '
+                        'queued for retry: %s', order_id, self.id, exception
+                    )
+                ImportJob.enqueue(self, failures)
+
+                orders_handled += len(orders)
+                if orders_handled - orders_checkpointed >= \
+                        checkpoint_interval:
+                    self.save_prestashop_checkpoint(orders[-1])
+                    orders_checkpointed = orders_handled
+
+            # The import is complete, the next one can start from here
             self.write([self], {
-                'last_order_import_time': utc_time_now
+                'last_order_import_time': utc_time_now,
+                'prestashop_checkpoint_time': None,
+                'prestashop_checkpoint_order_id': None,
+                'prestashop_checkpoint_date_upd': None,
             })
-            sales_imported = []
-            for order in orders_to_import:
 
-                # TODO: Use import_order here
-                sales_imported.append(Sale.find_or_create_using_ps_data(order))
+        return sales_imported
+
+    def split_prestashop_orders(self, orders):
+        """
+        Split a page of orders into the new orders, which are to be imported,
+        and the orders already imported. The update time and state of the
+        sales of the orders which changed since they were last seen are
+        refreshed, the unchanged ones are left alone.
+
+        :param orders: List of objectified XML records of orders
+        :returns: A tuple of the list of the new orders and the list of
+                  active records of the sales refreshed
+        """
+        Sale = Pool().get('sale.sale')
+
+        existing_sales = dict(
+            (sale.prestashop_id, sale) for sale in Sale.search([
+                ('prestashop_id', 'in', [o.id.pyval for o in orders]),
+                ('channel', '=', self.id),
+            ])
+        )
+        new_orders, changed_sales = [], []
+        for order in orders:
+            sale = existing_sales.get(order.id.pyval)
+            if sale is None:
+                new_orders.append(order)
+                continue
+            if not sale.is_changed_on_prestashop(order):
+                # Nothing relevant changed since the last import
+                continue
+            Sale.write([sale], {
+                'prestashop_date_upd': self.get_utc_time_using_ps_time(
+                    order.date_upd.pyval
+                ),
+                'prestashop_current_state': order.current_state.pyval,
+            })
+            changed_sales.append(sale)
+        return new_orders, changed_sales
+
+    def prefetch_prestashop_order_data(
+        self, client, orders, order_states=None
+    ):
+        """
+        Fetch in bulk the customers, addresses, order details and the
+        products not known to tryton yet, which are needed to import the
+        given page of orders. The orders are expected to be new ones.
+
+        The requests are sent concurrently, up to the maximum number of
+        concurrent requests set on the channel.
+
+        :param client: Prestashop client object
+        :param orders: List of objectified XML order records
+        :param order_states: Dictionary of the order states of the channel by
+                             prestashop ID, shared by all the pages imported
+        :returns: Instance of `RecordCache` holding the records fetched
+        """
+        TemplatePrestashop = Pool().get('product.template.prestashop')
+        ProductPrestashop = Pool().get('product.product.prestashop')
+
+        record_cache = self.get_prestashop_record_cache(client, order_states)
+        if isinstance(client, MockstaShopWebservice):
+            # The mock client cannot fetch the records in bulk
+            return record_cache
+
+        customer_ids, address_ids, order_detail_ids = set(), set(), set()
+        product_ids, combination_ids = set(), set()
+        for order in orders:
+            customer_ids.add(order.id_customer.pyval)
+            address_ids.add(order.id_address_invoice.pyval)
+            address_ids.add(order.id_address_delivery.pyval)
+            for order_row in order.associations.order_rows.iterchildren():
+                order_detail_ids.add(order_row.id.pyval)
+                if order_row.product_attribute_id.pyval != 0:
+                    combination_ids.add(order_row.product_attribute_id.pyval)
+                else:
+                    product_ids.add(order_row.product_id.pyval)
+
+        # Products and combinations already in tryton need not be fetched
+        combination_ids -= set(
+            record.prestashop_combination_id
+            for record in ProductPrestashop.search([
+                ('prestashop_combination_id', 'in', list(combination_ids)),
+                ('channel', '=', self.id),
+            ])
+        )
+        product_ids -= set(
+            record.prestashop_id for record in TemplatePrestashop.search([
+                ('prestashop_id', 'in', list(product_ids)),
+                ('channel', '=', self.id),
+            ])
+        )
+
+        record_cache.prefetch_many({
+            'customers': customer_ids,
+            'addresses': address_ids,
+            'order_details': order_detail_ids,
+            'combinations': combination_ids,
+            'products': product_ids,
+        })
+
+        # The products of the new combinations are known only now
+        record_cache.prefetch('products', [
+            combination.id_product.pyval for combination in
+            record_cache.records['combinations'].itervalues()
+        ])
+
+        return record_cache
+
+    def get_prestashop_record(self, resource, record_id):
+        """
+        Return the record of the given prestashop resource. The record is
+        read from the records prefetched for the current page of orders if
+        available, else it is fetched from prestashop.
+
+        :param resource: Name of the prestashop resource, eg: `customers`
+        :param record_id: Prestashop ID of the record
+        :returns: Objectified XML record
+        """
+        record_cache = get_record_cache()
+        if record_cache is not None and record_cache.channel_id == self.id:
+            return record_cache.get(resource, record_id)
+
+        record_cache = self.get_prestashop_record_cache(
+            self.get_prestashop_import_client()
+        )
+        return record_cache.get(resource, record_id)
+
+    def get_prestashop_record_cache(self, client, order_states=None):
+        """
+        Return a new record cache of this channel reading the records with
+        the given client.
+
+        The mock client used by the tests ignores the filters and the fields
+        to display, so the records are fetched one at a time with it.
+
+        :param client: Prestashop client object
+        :param order_states: Dictionary of the order states of the channel by
+                             prestashop ID, if loaded already
+        :returns: Instance of `RecordCache`
+        """
+        if isinstance(client, MockstaShopWebservice):
+            return RecordCache(self.id, client, order_states=order_states)
+        return RecordCache(
+            self.id, client,
+            max_workers=self.prestashop_max_connections or 1,
+            order_states=order_states,
+            display=self.get_prestashop_display_fields(),
+        )
+
+    def get_prestashop_display_fields(self):
+        """
+        Return the fields to be requested from prestashop for each resource
+        read by the `*_using_ps_data` methods, so that prestashop does not
+        send the fields which are never read. Every field is requested for
+        the resources not listed here.
+
+        Downstream modules reading more fields of a record must add them
+        here.
+
+        :returns: Dictionary of resource name and list of field names
+        """
+        return {
+            'customers': ['id', 'firstname', 'lastname', 'email', 'id_lang'],
+            'addresses': [
+                'id', 'firstname', 'lastname', 'address1', 'address2',
+                'postcode', 'city', 'id_country', 'id_state', 'phone',
+                'phone_mobile',
+            ],
+            'order_details': [
+                'id', 'product_quantity', 'unit_price_tax_excl',
+                'product_name',
+            ],
+            'products': [
+                'id', 'reference', 'name', 'description', 'price',
+                'wholesale_price',
+            ],
+            'combinations': ['id', 'id_product', 'reference'],
+            'countries': ['id', 'iso_code'],
+            'states': ['id', 'id_country', 'iso_code'],
+            'currencies': ['id', 'iso_code'],
+        }
+
+    def get_prestashop_order_state(self, prestashop_id):
+        """
+        Return the order state of this channel corresponding to the
+        prestashop ID. The order states loaded once for the current import
+        are used if available, else the order state is searched for.
+
+        :param prestashop_id: Prestashop ID of the order state
+        :returns: Site order state record found or None
+        """
+        SiteOrderState = Pool().get('prestashop.site.order_state')
+
+        record_cache = get_record_cache()
+        if record_cache is not None and record_cache.channel_id == self.id \
+                and record_cache.order_states is not None:
+            return record_cache.order_states.get(prestashop_id)
+
+        with Transaction().set_context(current_channel=self.id):
+            return SiteOrderState.search_using_ps_id(prestashop_id)
+
+    @contextmanager
+    def prestashop_lock(self):
+        """
+        Lock the channel while importing or exporting orders, so that two
+        synchronisations of the same channel never overlap, whichever the
+        process or server running them. The lock is not waited for, the
+        block gets False if another synchronisation holds it.
+
+        On postgresql a session level advisory lock is used, because the
+        order import commits its progress on the way. It is taken on a
+        connection of its own, so that it is released even if the
+        transaction of the synchronisation fails. Other databases are not
+        locked.
+        """
+        if backend.name() != 'postgresql':
+            yield True
+            return
+
+        Database = backend.get('Database')
+        database = Database(Transaction().cursor.database_name).connect()
+        cursor = database.cursor(autocommit=True)
+        try:
+            cursor.execute(
+                'SELECT pg_try_advisory_lock(%s, %s)',
+                (ADVISORY_LOCK_KEY, self.id)
+            )
+            locked, = cursor.fetchone()
+            try:
+                yield locked
+            finally:
+                if locked:
+                    cursor.execute(
+                        'SELECT pg_advisory_unlock(%s, %s)',
+                        (ADVISORY_LOCK_KEY, self.id)
+                    )
+        finally:
+            cursor.close()
+
+    def save_prestashop_checkpoint(self, order_record):
+        """
+        Save the order given as the last one imported by the current import
+        and commit the transaction, so that an interrupted import can be
+        resumed from this order onwards.
+
+        :param order_record: Objectified XML record of the last order imported
+        """
+        self.write([self], {
+            'prestashop_checkpoint_order_id': order_record.id.pyval,
+            'prestashop_checkpoint_date_upd': self.get_utc_time_using_ps_time(
+                order_record.date_upd.pyval
+            ),
+        })
+        self.commit_prestashop_progress()
+
+    def get_utc_time_using_ps_time(self, value):
+        """
+        Convert a time sent by prestashop, which is in the timezone of the
+        site, to a naive UTC datetime as stored by tryton
+
+        :param value: Time as sent by prestashop, eg: `2015-01-31 14:05:00`
+        :returns: Naive datetime in UTC
+        """
+        site_tz = pytz.timezone(self.prestashop_timezone)
+        site_time = site_tz.localize(
+            datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+        )
+        return pytz.utc.normalize(site_time).replace(tzinfo=None)
+
+    def commit_prestashop_progress(self):
+        """
+        Commit the work done so far by a long running prestashop
+        synchronisation, so that it is not lost if the process dies.
+
+        Nothing is committed while running against the mock client since
+        the tests rely on their transaction being rolled back.
+        """
+        if Transaction().context.get('ps_test'):
+            return
+        Transaction().cursor.commit()
+
+    def get_prestashop_order_pages(self, client, filters=None, last_id=0):
+        """
+        Fetch the orders to be imported from prestashop one page at a time.
+
+        The pages are walked in ascending order of order ID, each page asking
+        for the orders with an ID greater than the last one of the previous
+        page. Unlike a `limit=offset,count` window, this neither skips nor
+        repeats orders when the orders matching the filters change while the
+        pages are walked. Each page is meant to be discarded by the caller
+        once handled, which keeps the memory used flat no matter how many
+        orders the site has. The import client parses each page as it is
+        received, so only the order records themselves are kept.
+
+        :param client: Prestashop client object
+        :param filters: Filters to be sent to the webservice, if any
+        :param last_id: ID of the order after which the pages start
+        :returns: A generator of lists of objectified XML order records
+        """
+        page_size = self.prestashop_import_page_size or \
+            DEFAULT_IMPORT_PAGE_SIZE
+        filters = dict(filters or {})
+        params = {
+            'display': 'full',
+            'sort': [('id', 'ASC')],
+            'filters': filters,
+            'limit': page_size,
+        }
+        if 'date_upd' in filters:
+            params['date'] = 1
+
+        while True:
+            filters['id'] = '{0},{1}'.format(last_id + 1, MAX_PRESTASHOP_ID)
+            orders = client.orders.get_list(**params)
+            count = len(orders)
+            if not count:
+                break
+            last_id = orders[-1].id.pyval
+
+            yield orders
+
+            # Drop the reference to the page before the next one is fetched
+            del orders
+            if count < page_size:
+                # This was the last page
+                break
+
+    @classmethod
+    def import_prestashop_orders_using_cron(cls):
+        """
+        Import orders from all the prestashop channels using cron
+
+        The channels are imported in parallel, each one in its own thread
+        and transaction, so that a slow site does not hold back the others.
+
+        :returns: Dictionary of channel ID and the number of sales imported,
+                  None for the channels which were skipped or failed
+        """
+        channels = cls.search([
+            ('source', '=', 'prestashop')
+        ])
+        if not channels:
+            return {}
+
+        transaction = Transaction()
+        args = [(
+            transaction.cursor.database_name, transaction.user,
+            transaction.context.copy(), channel.id,
+        ) for channel in channels]
+
+        pool = ThreadPool(min(IMPORT_WORKERS, len(args)))
+        try:
+            results = pool.map(cls._import_prestashop_orders_in_worker, args)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip([channel.id for channel in channels], results))
+
+    @classmethod
+    def _import_prestashop_orders_in_worker(cls, args):
+        """
+        Import the orders of a single channel in a new transaction, which is
+        committed once the import completes. This is run in the worker
+        threads of `import_prestashop_orders_using_cron`.
+
+        The orders of a channel are not imported if an import of the channel
+        is already running in this process.
+
+        :param args: Tuple of database name, user, context and channel ID
+        :returns: Number of sales imported or None
+        """
+        database_name, user, context, channel_id = args
+
+        with _import_locks_lock:
+            lock = _import_locks.setdefault(channel_id, threading.Lock())
+        if not lock.acquire(False):
+            logger.info(
+                'Orders of channel %s are already being imported', channel_id
+            )
+            return None
+
+        try:
+            with Transaction().start(
+                    database_name, user, context=context) as transaction:
+                try:
+                    sales = cls(channel_id).import_orders()
+                    transaction.cursor.commit()
+                except Exception:
+                    transaction.cursor.rollback()
+                    logger.exception(
+                        'Import of orders of channel %s failed', channel_id
+                    )
+                    return None
+                return len(sales)
+        finally:
+            lock.release()
+
+    @classmethod
+    def process_prestashop_import_jobs_using_cron(cls):
+        """
+        Retry the import of the queued orders of all the prestashop channels
+        using cron
+        """
+        ImportJob = Pool().get('prestashop.import.job')
+
+        jobs = ImportJob.search([
+            ('state', '=', 'pending'),
+            ('next_attempt', '<=', datetime.utcnow()),
+        ])
+        for channel in set(job.channel for job in jobs):
+            channel.process_prestashop_import_jobs()
+
+    @with_prestashop_lock
+    def process_prestashop_import_jobs(self):
+        """
+        Retry the import of the orders queued for this channel whose next
+        attempt is due. The orders are fetched and imported in small
+        batches, and the outcome of each batch is committed.
+
+        :returns: The list of active records of sales imported
+        """
+        Sale = Pool().get('sale.sale')
+        ImportJob = Pool().get('prestashop.import.job')
+
+        jobs = ImportJob.search([
+            ('channel', '=', self.id),
+            ('state', '=', 'pending'),
+            ('next_attempt', '<=', datetime.utcnow()),
+        ])
+        if not jobs:
+            return []
+
+        client = self.get_prestashop_import_client()
+        order_states = dict(
+            (state.prestashop_id, state)
+            for state in self.prestashop_order_states
+        )
+        sales_imported = []
+        with Transaction().set_context(current_channel=self.id):
+            for index in xrange(0, len(jobs), JOB_BATCH_SIZE):
+                batch = jobs[index:index + JOB_BATCH_SIZE]
+                order_ids = [job.prestashop_id for job in batch]
+
+                # The orders imported since the jobs were queued are done
+                sales = Sale.search([
+                    ('prestashop_id', 'in', order_ids),
+                    ('channel', '=', self.id),
+                ])
+                imported_ids = set(sale.prestashop_id for sale in sales)
+                order_ids = [
+                    order_id for order_id in order_ids
+                    if order_id not in imported_ids
+                ]
+
+                failures = []
+                try:
+                    orders = order_ids and client.orders.get_list(
+                        filters={'id': '|'.join(map(str, order_ids))},
+                        display='full',
+                    ) or []
+                    record_cache = self.prefetch_prestashop_order_data(
+                        client, orders, order_states
+                    )
+                except Exception as exception:
+                    # The whole batch is retried later, eg: on a network
+                    # error
+                    failures = [
+                        (order_id, exception) for order_id in order_ids
+                    ]
+                else:
+                    with using_record_cache(record_cache):
+                        new_sales, failures = Sale.create_all_using_ps_data(
+                            orders
+                        )
+                    del record_cache
+                    sales.extend(new_sales)
+                    sales_imported.extend(new_sales)
+
+                ImportJob.save_results(batch, sales, failures)
+                self.commit_prestashop_progress()
 
         return sales_imported
 
@@ -320,16 +1050,20 @@ class Channel:
         """
         pass
 
+    @with_prestashop_lock
     def export_orders_to_prestashop(self):
         """
         Export order status to prestashop current site
         Export only those orders which are modified after the
         `last order export time` as set in the prestashop configuration.
+        The orders which could not be exported are exported again by the
+        next exports, along with the orders modified since this one.
+        Nothing is exported while the channel is locked by another
+        synchronisation
 
         :returns: The list of active records of sales exported
         """
         Sale = Pool().get('sale.sale')
-        Move = Pool().get('stock.move')
 
         if not self.prestashop_order_states:
             self.raise_user_error('order_states_not_imported')
@@ -339,39 +1073,88 @@ class Channel:
         self.validate_prestashop_channel()
 
         with Transaction().set_context(current_channel=self.id):
-            if self.last_order_export_time:
-                # Sale might not get updated for state changes in the related
-                # shipments.
-                # So first get the moves for outgoing shipments which are \
-                # executed after last import time.
-                moves = Move.search([
-                    (
-                        'write_date', '>=',
-                        self.last_order_export_time
-                    ),
-                    ('sale.channel', '=', self.id),
-                    ('shipment', 'like', 'stock.shipment.out%')
-                ])
-                sales_to_export = Sale.search(['OR', [
-                    (
-                        'write_date', '>=',
-                        self.last_order_export_time
-                    ),
-                    ('channel', '=', self.id),
-                ], [
-                    ('id', 'in', map(int, [m.sale for m in moves]))
-                ]])
-            else:
-                sales_to_export = Sale.search([('channel', '=', self.id)])
+            sales_to_export = Sale.browse(
+                self.get_prestashop_sale_ids_to_export()
+            )
+
+            # The sales skipped as their order is already in the state on
+            # prestashop are not counted as exported
+            exported_ids, failures = [], []
+            for index in xrange(0, len(sales_to_export), EXPORT_BATCH_SIZE):
+                orders, batch_failures = Sale.export_statuses_to_ps(
+                    sales_to_export[index:index + EXPORT_BATCH_SIZE]
+                )
+                exported_ids.extend(orders.keys())
+                failures.extend(batch_failures)
 
+            # The sales which could not be exported are flagged for the next
+            # export, so the export time moves on whatever failed
             self.write([self], {
                 'last_order_export_time': time_now
             })
 
-            for sale in sales_to_export:
-                sale.export_status_to_ps()
+        return Sale.browse(exported_ids)
 
-        return sales_to_export
+    def get_prestashop_sale_ids_to_export(self):
+        """
+        Return the IDs of the sales of this channel whose state is to be
+        exported, i.e. the ones modified after the `last order export time`,
+        the ones whose outgoing moves were modified since then and the ones
+        which could not be exported by the last export. All the sales of the
+        channel are returned if nothing was exported yet.
+
+        The sales are found by a single query, without reading the moves.
+
+        :returns: List of sale IDs
+        """
+        Sale = Pool().get('sale.sale')
+        SaleLine = Pool().get('sale.line')
+        Move = Pool().get('stock.move')
+
+        sale = Sale.__table__()
+        cursor = Transaction().cursor
+
+        if not self.last_order_export_time:
+            cursor.execute(*sale.select(
+                sale.id, where=sale.channel == self.id
+            ))
+            return [sale_id for sale_id, in cursor.fetchall()]
+
+        # Sale might not get updated for state changes in the related
+        # shipments. So the sales of the moves of outgoing shipments which
+        # are modified after the last export are exported too.
+        move = Move.__table__()
+        sale_line = SaleLine.__table__()
+        move_sale = Sale.__table__()
+        in_channel = sale.channel == self.id
+        query = Union(
+            sale.select(
+                sale.id,
+                where=in_channel & (
+                    sale.write_date >= self.last_order_export_time
+                )
+            ),
+            move.join(
+                sale_line, condition=move.origin == Concat(
+                    'sale.line,', Cast(sale_line.id, 'VARCHAR')
+                )
+            ).join(
+                move_sale, condition=sale_line.sale == move_sale.id
+            ).select(
+                move_sale.id,
+                where=(move_sale.channel == self.id) & (
+                    move.write_date >= self.last_order_export_time
+                ) & move.shipment.like('stock.shipment.out%')
+            ),
+            sale.select(
+                sale.id,
+                where=in_channel & (
+                    sale.prestashop_export_failed == True  # noqa
+                )
+            )
+        )
+        cursor.execute(*query)
+        return [sale_id for sale_id, in cursor.fetchall()]
 
     def import_product(self, order_row_record):
         """
@@ -387,16 +1170,14 @@ class Channel:
         if self.source != 'prestashop':
             return super(Channel, self).import_product(order_row_record)
 
-        client = self.get_prestashop_client()
-
         # If the product sold is a variant, then get product from
         # product.product
         if order_row_record.product_attribute_id.pyval != 0:
             product = Product.get_product_using_ps_id(
                 order_row_record.product_attribute_id.pyval
             ) or Product.find_or_create_using_ps_data(
-                client.combinations.get(
-                    order_row_record.product_attribute_id.pyval
+                self.get_prestashop_record(
+                    'combinations', order_row_record.product_attribute_id.pyval
                 )
             )
 
@@ -404,8 +1185,8 @@ class Channel:
             template = Template.get_template_using_ps_id(
                 order_row_record.product_id.pyval
             ) or Template.find_or_create_using_ps_data(
-                client.products.get(
-                    order_row_record.product_id.pyval
+                self.get_prestashop_record(
+                    'products', order_row_record.product_id.pyval
                 )
             )
             product = template.products[0]
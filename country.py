@@ -8,6 +8,7 @@
 from trytond.model import ModelSQL, fields
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
 
 
 __all__ = [
@@ -16,7 +17,38 @@ __all__ = [
 __metaclass__ = PoolMeta
 
 
-class CountryPrestashop(ModelSQL):
+class PrestashopIdCacheMixin(object):
+    """Mixin of the models mapping prestashop IDs to tryton records, which
+    keep the tryton ID of the mappings looked up by channel and prestashop
+    ID in `_get_using_ps_id_cache`. The cache is cleared whenever a mapping
+    is created, modified or deleted.
+    """
+
+    #: Cache of the tryton ID by channel and prestashop ID, to be set by the
+    #: models using the mixin
+    _get_using_ps_id_cache = None
+
+    @classmethod
+    def create(cls, vlist):
+        "Clear the lookup cache when mappings are created"
+        records = super(PrestashopIdCacheMixin, cls).create(vlist)
+        cls._get_using_ps_id_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        "Clear the lookup cache when mappings are modified"
+        super(PrestashopIdCacheMixin, cls).write(*args)
+        cls._get_using_ps_id_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        "Clear the lookup cache when mappings are deleted"
+        super(PrestashopIdCacheMixin, cls).delete(records)
+        cls._get_using_ps_id_cache.clear()
+
+
+class CountryPrestashop(PrestashopIdCacheMixin, ModelSQL):
     """Prestashop country cache
 
     This model keeps a store of tryton country corresponding to the country
@@ -32,6 +64,11 @@ class CountryPrestashop(ModelSQL):
     channel = fields.Many2One('sale.channel', 'Channel', required=True)
     prestashop_id = fields.Integer('Prestashop ID', required=True)
 
+    #: Cache of the country ID by channel and prestashop ID
+    _get_using_ps_id_cache = Cache(
+        'country.country.prestashop.get_using_ps_id', context=False
+    )
+
     @staticmethod
     def default_channel():
         "Return default channel from context"
@@ -48,7 +85,7 @@ class CountryPrestashop(ModelSQL):
         ]
 
 
-class SubdivisionPrestashop(ModelSQL):
+class SubdivisionPrestashop(PrestashopIdCacheMixin, ModelSQL):
     """Prestashop subdivision cache
 
     This model keeps a store of tryton subdivision corresponding to the state
@@ -66,6 +103,11 @@ class SubdivisionPrestashop(ModelSQL):
     channel = fields.Many2One('sale.channel', 'Channel', required=True)
     prestashop_id = fields.Integer('Prestashop ID', required=True)
 
+    #: Cache of the subdivision ID by channel and prestashop ID
+    _get_using_ps_id_cache = Cache(
+        'country.subdivision.prestashop.get_using_ps_id', context=False
+    )
+
     @staticmethod
     def default_channel():
         "Return default channel from context"
@@ -105,15 +147,57 @@ class Country:
         """
         CountryPrestashop = Pool().get('country.country.prestashop')
 
+        key = (Transaction().context.get('current_channel'), prestashop_id)
+        country_id = CountryPrestashop._get_using_ps_id_cache.get(key)
+        if country_id is not None:
+            return cls(country_id)
+
         records = CountryPrestashop.search([
-            ('channel', '=', Transaction().context.get('current_channel')),
+            ('channel', '=', key[0]),
             ('prestashop_id', '=', prestashop_id)
         ])
 
         if records:
-            return records[0].country
-        # Country is not cached yet, cache it and return
-        return cls.cache_prestashop_id(prestashop_id)
+            country = records[0].country
+        else:
+            # Country is not cached yet, cache it and return
+            country = cls.cache_prestashop_id(prestashop_id)
+
+        if country:
+            CountryPrestashop._get_using_ps_id_cache.set(key, country.id)
+        return country
+
+    @classmethod
+    def cache_prestashop_records(cls, country_records):
+        """Cache the countries corresponding to all the country records given
+        in one go, skipping the ones already cached and the ones for which no
+        country exists in tryton.
+
+        :param country_records: List of objectified XML country records
+        :returns: List of active records of the cache created
+        """
+        CountryPrestashop = Pool().get('country.country.prestashop')
+
+        channel_id = Transaction().context['current_channel']
+        cached_ids = set(
+            record.prestashop_id for record in CountryPrestashop.search([
+                ('channel', '=', channel_id)
+            ])
+        )
+
+        country_records = [
+            record for record in country_records
+            if record.id.pyval not in cached_ids
+        ]
+        countries = dict((country.code, country.id) for country in cls.search([
+            ('code', 'in', [r.iso_code.pyval for r in country_records])
+        ]))
+
+        return CountryPrestashop.create([{
+            'country': countries[record.iso_code.pyval],
+            'channel': channel_id,
+            'prestashop_id': record.id.pyval,
+        } for record in country_records if record.iso_code.pyval in countries])
 
     @classmethod
     def cache_prestashop_id(cls, prestashop_id):
@@ -129,9 +213,9 @@ class Country:
         channel = SaleChannel(Transaction().context['current_channel'])
         channel.validate_prestashop_channel()
 
-        client = channel.get_prestashop_client()
-
-        country_data = client.countries.get(prestashop_id)
+        country_data = channel.get_prestashop_record(
+            'countries', prestashop_id
+        )
         country = cls.search([('code', '=', country_data.iso_code.pyval)])
 
         if not country:
@@ -170,15 +254,75 @@ class Subdivision:
         """
         SubdivisionPrestashop = Pool().get('country.subdivision.prestashop')
 
+        key = (Transaction().context.get('current_channel'), prestashop_id)
+        subdivision_id = SubdivisionPrestashop._get_using_ps_id_cache.get(key)
+        if subdivision_id is not None:
+            return cls(subdivision_id)
+
         records = SubdivisionPrestashop.search([
-            ('channel', '=', Transaction().context.get('current_channel')),
+            ('channel', '=', key[0]),
             ('prestashop_id', '=', prestashop_id)
         ])
 
         if records:
-            return records[0].subdivision
-        # Subdivision is not cached yet, cache it and return
-        return cls.cache_prestashop_id(prestashop_id)
+            subdivision = records[0].subdivision
+        else:
+            # Subdivision is not cached yet, cache it and return
+            subdivision = cls.cache_prestashop_id(prestashop_id)
+
+        if subdivision:
+            SubdivisionPrestashop._get_using_ps_id_cache.set(
+                key, subdivision.id
+            )
+        return subdivision
+
+    @classmethod
+    def cache_prestashop_records(cls, state_records):
+        """Cache the subdivisions corresponding to all the state records given
+        in one go, skipping the ones already cached and the ones for which no
+        subdivision exists in tryton.
+
+        The countries of the states are expected to have been cached already.
+
+        :param state_records: List of objectified XML state records
+        :returns: List of active records of the cache created
+        """
+        SubdivisionPrestashop = Pool().get('country.subdivision.prestashop')
+        CountryPrestashop = Pool().get('country.country.prestashop')
+
+        channel_id = Transaction().context['current_channel']
+        cached_ids = set(
+            record.prestashop_id for record in SubdivisionPrestashop.search([
+                ('channel', '=', channel_id)
+            ])
+        )
+        country_codes = dict(
+            (record.prestashop_id, record.country.code)
+            for record in CountryPrestashop.search([
+                ('channel', '=', channel_id)
+            ])
+        )
+
+        codes = {}
+        for record in state_records:
+            if record.id.pyval in cached_ids or \
+                    record.id_country.pyval not in country_codes:
+                continue
+            codes[record.id.pyval] = '-'.join([
+                country_codes[record.id_country.pyval],
+                record.iso_code.pyval
+            ])
+        subdivisions = dict(
+            (subdivision.code, subdivision.id)
+            for subdivision in cls.search([('code', 'in', codes.values())])
+        )
+
+        return SubdivisionPrestashop.create([{
+            'subdivision': subdivisions[code],
+            'channel': channel_id,
+            'prestashop_id': prestashop_id,
+        } for prestashop_id, code in codes.iteritems()
+            if code in subdivisions])
 
     @classmethod
     def cache_prestashop_id(cls, prestashop_id):
@@ -195,9 +339,9 @@ class Subdivision:
         channel = SaleChannel(Transaction().context['current_channel'])
         channel.validate_prestashop_channel()
 
-        client = channel.get_prestashop_client()
-
-        state_data = client.states.get(prestashop_id)
+        state_data = channel.get_prestashop_record(
+            'states', prestashop_id
+        )
         # The country should have been cached till now for sure
         country = Country.get_using_ps_id(state_data.id_country.pyval)
         subdivision = cls.search([
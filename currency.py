@@ -8,6 +8,9 @@
 from trytond.model import ModelSQL, fields
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
+
+from country import PrestashopIdCacheMixin
 
 
 __all__ = [
@@ -16,7 +19,7 @@ __all__ = [
 __metaclass__ = PoolMeta
 
 
-class CurrencyPrestashop(ModelSQL):
+class CurrencyPrestashop(PrestashopIdCacheMixin, ModelSQL):
     """Prestashop currency cache
 
     This model keeps a store of tryton currency corresponding to the currency
@@ -32,6 +35,11 @@ class CurrencyPrestashop(ModelSQL):
     channel = fields.Many2One('sale.channel', 'Channel', required=True)
     prestashop_id = fields.Integer('Prestashop ID', required=True)
 
+    #: Cache of the currency ID by channel and prestashop ID
+    _get_using_ps_id_cache = Cache(
+        'currency.currency.prestashop.get_using_ps_id', context=False
+    )
+
     @staticmethod
     def default_channel():
         "Return default channel from context"
@@ -68,15 +76,60 @@ class Currency:
         """
         CurrencyPrestashop = Pool().get('currency.currency.prestashop')
 
+        key = (Transaction().context.get('current_channel'), prestashop_id)
+        currency_id = CurrencyPrestashop._get_using_ps_id_cache.get(key)
+        if currency_id is not None:
+            return cls(currency_id)
+
         records = CurrencyPrestashop.search([
-            ('channel', '=', Transaction().context.get('current_channel')),
+            ('channel', '=', key[0]),
             ('prestashop_id', '=', prestashop_id)
         ])
 
         if records:
-            return records[0].currency
-        # Currency is not cached yet, cache it and return
-        return cls.cache_prestashop_id(prestashop_id)
+            currency = records[0].currency
+        else:
+            # Currency is not cached yet, cache it and return
+            currency = cls.cache_prestashop_id(prestashop_id)
+
+        if currency:
+            CurrencyPrestashop._get_using_ps_id_cache.set(key, currency.id)
+        return currency
+
+    @classmethod
+    def cache_prestashop_records(cls, currency_records):
+        """Cache the currencies corresponding to all the currency records
+        given in one go, skipping the ones already cached and the ones for
+        which no currency exists in tryton.
+
+        :param currency_records: List of objectified XML currency records
+        :returns: List of active records of the cache created
+        """
+        CurrencyPrestashop = Pool().get('currency.currency.prestashop')
+
+        channel_id = Transaction().context['current_channel']
+        cached_ids = set(
+            record.prestashop_id for record in CurrencyPrestashop.search([
+                ('channel', '=', channel_id)
+            ])
+        )
+
+        currency_records = [
+            record for record in currency_records
+            if record.id.pyval not in cached_ids
+        ]
+        currencies = dict(
+            (currency.code, currency.id) for currency in cls.search([
+                ('code', 'in', [r.iso_code.pyval for r in currency_records])
+            ])
+        )
+
+        return CurrencyPrestashop.create([{
+            'currency': currencies[record.iso_code.pyval],
+            'channel': channel_id,
+            'prestashop_id': record.id.pyval,
+        } for record in currency_records
+            if record.iso_code.pyval in currencies])
 
     @classmethod
     def cache_prestashop_id(cls, prestashop_id):
@@ -92,9 +145,9 @@ class Currency:
         channel = SaleChannel(Transaction().context.get('current_channel'))
         channel.validate_prestashop_channel()
 
-        client = channel.get_prestashop_client()
-
-        currency_data = client.currencies.get(prestashop_id)
+        currency_data = channel.get_prestashop_record(
+            'currencies', prestashop_id
+        )
         currency = cls.search([('code', '=', currency_data.iso_code.pyval)])
 
         if not currency:
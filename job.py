@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    job
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+from datetime import datetime, timedelta
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import PoolMeta
+from trytond.pyson import Eval
+
+
+__all__ = ['ImportJob']
+__metaclass__ = PoolMeta
+
+#: Number of times the import of an order is tried before giving up
+MAX_ATTEMPTS = 6
+
+#: Delay in seconds before the first retry, doubled for every next one
+RETRY_DELAY = 300
+
+
+class ImportJob(ModelSQL, ModelView):
+    """Prestashop Import Job
+
+    An order which could not be imported is queued here and its import is
+    retried later, with an exponentially increasing delay between the
+    attempts. Once all the attempts fail, the job is left in the failed
+    state for it to be looked into and retried by hand.
+    """
+    __name__ = 'prestashop.import.job'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, readonly=True,
+        ondelete='CASCADE', select=True
+    )
+    prestashop_id = fields.Integer(
+        'Prestashop Order ID', required=True, readonly=True
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True)
+    last_error = fields.Text('Last Error', readonly=True)
+    sale = fields.Many2One('sale.sale', 'Sale', readonly=True)
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def __setup__(cls):
+        super(ImportJob, cls).__setup__()
+        cls._sql_constraints += [(
+            'prestashop_id_channel_uniq',
+            'UNIQUE(prestashop_id, channel)',
+            'Import job must be unique by prestashop id and channel'
+        )]
+        cls._order.insert(0, ('next_attempt', 'ASC'))
+        cls._buttons.update({
+            'retry': {
+                'invisible': Eval('state') == 'pending',
+            },
+        })
+
+    @classmethod
+    def get_retry_time(cls, attempts):
+        """Return the time of the next attempt of a job which failed the
+        given number of times.
+
+        :param attempts: Number of attempts made so far
+        :returns: Naive datetime in UTC
+        """
+        return datetime.utcnow() + timedelta(
+            seconds=RETRY_DELAY * 2 ** (attempts - 1)
+        )
+
+    @classmethod
+    def enqueue(cls, channel, failures):
+        """Queue the orders which failed to be imported by the order import
+        of the channel, so that their import is retried later. The failed
+        import counts as the first attempt.
+
+        :param channel: Active record of the sale channel
+        :param failures: List of tuples of prestashop order ID and exception
+        :returns: List of the jobs queued
+        """
+        if not failures:
+            return []
+
+        jobs = dict(
+            (job.prestashop_id, job) for job in cls.search([
+                ('channel', '=', channel.id),
+                ('prestashop_id', 'in', [ps_id for ps_id, _ in failures]),
+            ])
+        )
+        # A job already pending is retried as planned, a finished one is
+        # started over
+        to_restart = [
+            job for job in jobs.itervalues() if job.state != 'pending'
+        ]
+        if to_restart:
+            cls.write(to_restart, {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': datetime.utcnow(),
+            })
+
+        vlist = [{
+            'channel': channel.id,
+            'prestashop_id': ps_id,
+            'attempts': 1,
+            'next_attempt': cls.get_retry_time(1),
+            'last_error': unicode(exception),
+        } for ps_id, exception in failures if ps_id not in jobs]
+        return to_restart + cls.create(vlist)
+
+    @classmethod
+    def save_results(cls, jobs, sales, failures):
+        """Save the outcome of an attempt to import the orders of the jobs.
+
+        :param jobs: List of the jobs attempted
+        :param sales: List of active records of the sales of the orders,
+                      whether created by this attempt or earlier
+        :param failures: List of tuples of prestashop order ID and exception
+        """
+        sales = dict((sale.prestashop_id, sale) for sale in sales)
+        errors = dict(failures)
+
+        for job in jobs:
+            sale = sales.get(job.prestashop_id)
+            if sale is not None:
+                cls.write([job], {
+                    'state': 'done',
+                    'sale': sale.id,
+                    'next_attempt': None,
+                })
+                continue
+
+            attempts = job.attempts + 1
+            values = {
+                'attempts': attempts,
+                'last_error': unicode(errors.get(
+                    job.prestashop_id, 'Order not found on prestashop'
+                )),
+            }
+            if attempts >= MAX_ATTEMPTS:
+                values.update({
+                    'state': 'failed',
+                    'next_attempt': None,
+                })
+            else:
+                values['next_attempt'] = cls.get_retry_time(attempts)
+            cls.write([job], values)
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, jobs):
+        """Queue the jobs again to be retried as soon as possible
+        """
+        cls.write(jobs, {
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': datetime.utcnow(),
+        })
@@ -5,6 +5,9 @@
     :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
+import hashlib
+
+from trytond import backend
 from trytond.model import fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
@@ -110,6 +113,145 @@ class Address:
         'get_prestashop_channel'
     )
 
+    #: Hash of the fields matched against a prestashop address. It is indexed
+    #: so that an address from prestashop is found with a single lookup.
+    prestashop_fingerprint = fields.Char(
+        'Prestashop Fingerprint', readonly=True, select=True
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(Address, cls).__register__(module_name)
+
+        # Index the addresses from prestashop by their prestashop id. There is
+        # no channel on an address, the party of the address belongs to one.
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['prestashop_id', 'party'], 'add')
+
+        # Migration: store the fingerprint of the addresses imported before
+        # fingerprints were stored
+        sql_table = cls.__table__()
+        cursor.execute(*sql_table.select(
+            sql_table.id, sql_table.prestashop_id, sql_table.name,
+            sql_table.street, sql_table.streetbis, sql_table.zip,
+            sql_table.city, sql_table.country, sql_table.subdivision,
+            where=(sql_table.prestashop_id != None)  # noqa
+            & (sql_table.prestashop_fingerprint == None)  # noqa
+        ))
+        for row in cursor.fetchall():
+            cursor.execute(*sql_table.update(
+                columns=[sql_table.prestashop_fingerprint],
+                values=[cls.get_prestashop_fingerprint(row[1:])],
+                where=sql_table.id == row[0]
+            ))
+
+    @classmethod
+    def create(cls, vlist):
+        "Store the fingerprint of the addresses from prestashop"
+        vlist = [values.copy() for values in vlist]
+        for values in vlist:
+            if values.get('prestashop_id'):
+                values['prestashop_fingerprint'] = \
+                    cls.get_prestashop_fingerprint([
+                        values['prestashop_id'], values.get('name'),
+                        values.get('street'), values.get('streetbis'),
+                        values.get('zip'), values.get('city'),
+                        values.get('country'), values.get('subdivision'),
+                    ])
+        return super(Address, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        "Keep the fingerprint of the addresses from prestashop up to date"
+        super(Address, cls).write(*args)
+
+        fingerprint_fields = set([
+            'prestashop_id', 'name', 'street', 'streetbis', 'zip', 'city',
+            'country', 'subdivision',
+        ])
+        actions = iter(args)
+        addresses = []
+        for records, values in zip(actions, actions):
+            if fingerprint_fields & set(values.keys()):
+                addresses.extend(records)
+        cls.update_prestashop_fingerprint(addresses)
+
+    @classmethod
+    def update_prestashop_fingerprint(cls, addresses):
+        """Recompute and store the fingerprint of the addresses given
+
+        :param addresses: List of active records of address
+        """
+        for address in addresses:
+            if not address.prestashop_id:
+                continue
+            fingerprint = address.get_prestashop_fingerprint([
+                address.prestashop_id, address.name, address.street,
+                address.streetbis, address.zip, address.city,
+                address.country and address.country.id,
+                address.subdivision and address.subdivision.id,
+            ])
+            if fingerprint != address.prestashop_fingerprint:
+                super(Address, cls).write([address], {
+                    'prestashop_fingerprint': fingerprint,
+                })
+
+    @staticmethod
+    def get_prestashop_fingerprint(values):
+        """Return the fingerprint for the values of an address, which are the
+        prestashop ID, name, streets, zip, city, country ID and subdivision ID
+        in that order.
+
+        Empty values are normalised and everything is compared as a string
+        since zip and streets may be numbers on one side and strings on the
+        other.
+
+        :param values: List of values
+        :returns: Hexadecimal digest
+        """
+        return hashlib.sha1(u'\x1f'.join(
+            unicode(value) if value not in (None, '') else u''
+            for value in values
+        ).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_prestashop_fingerprint_using_ps_data(cls, address_record):
+        """Return the fingerprint of the address_record, comparable to the
+        one stored on the addresses in tryton.
+
+        :param address_record: Objectified XML record sent by pystashop
+        :returns: Hexadecimal digest
+        """
+        Country = Pool().get('country.country')
+        Subdivision = Pool().get('country.subdivision')
+
+        country = None
+        subdivision = None
+        if address_record.id_country:
+            country = Country.get_using_ps_id(
+                address_record.id_country.pyval
+            )
+        if address_record.id_state:
+            subdivision = Subdivision.get_using_ps_id(
+                address_record.id_state.pyval
+            )
+        return cls.get_prestashop_fingerprint([
+            address_record.id.pyval,
+            u' '.join([
+                address_record.firstname.pyval,
+                address_record.lastname.pyval
+            ]),
+            address_record.address1.pyval,
+            address_record.address2.pyval,
+            address_record.postcode.pyval,
+            address_record.city.pyval,
+            country and country.id,
+            subdivision and subdivision.id,
+        ])
+
     def get_prestashop_channel(self, name):
         """Return the channel from the party
 
@@ -128,15 +270,17 @@ class Address:
         :param party: Active Record of Party
         :returns: Active record of created address
         """
-        for address in party.addresses:
-            if address.match_with_ps_data(address_record):
-                break
-        else:
-            address = cls.create_for_party_using_ps_data(
-                party, address_record
-            )
-
-        return address
+        fingerprint = cls.get_prestashop_fingerprint_using_ps_data(
+            address_record
+        )
+        addresses = cls.search([
+            ('party', '=', party.id),
+            ('prestashop_fingerprint', '=', fingerprint),
+        ], limit=1)
+        if addresses:
+            return addresses[0]
+
+        return cls.create_for_party_using_ps_data(party, address_record)
 
     @classmethod
     def create_for_party_using_ps_data(cls, party, address_record):
@@ -268,16 +412,32 @@ class ContactMechanism:
             }]
         :returns: Active records of created/found records
         """
-        new_records = []
+        if not data:
+            return []
+
+        # Look up all the mechanisms in one query. The search matches a
+        # superset of the (party, type, value) tuples, which are then
+        # compared exactly.
+        existing = set(
+            (mechanism.party.id, mechanism.type, mechanism.value)
+            for mechanism in cls.search([
+                ('party', 'in', list(set(d['party'] for d in data))),
+                ('type', 'in', list(set(d['type'] for d in data))),
+                ('value', 'in', list(set(d['value'] for d in data))),
+            ])
+        )
 
+        new_records = []
         for mechanism_data in data:
-            # Check if a record exists with the set of values provided
-            if not cls.search([
-                ('party', '=', mechanism_data['party']),
-                ('type', '=', mechanism_data['type']),
-                ('value', '=', mechanism_data['value'])
-            ]):
-                new_records.append(mechanism_data)
+            key = (
+                mechanism_data['party'], mechanism_data['type'],
+                mechanism_data['value']
+            )
+            # Skip the ones which exist or are repeated in data
+            if key in existing:
+                continue
+            existing.add(key)
+            new_records.append(mechanism_data)
 
         if new_records:
             return cls.create(new_records)
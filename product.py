@@ -7,6 +7,9 @@
 """
 from decimal import Decimal, ROUND_HALF_EVEN
 
+from sql.aggregate import Count
+
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
@@ -274,6 +277,18 @@ class ProductPrestashop(ModelSQL, ModelView):
         "Return default channel from context"
         return Transaction().context.get('current_channel')
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(ProductPrestashop, cls).__register__(module_name)
+
+        # Combinations are looked up by their prestashop id in a channel,
+        # which unlike the other prestashop ids is not covered by a unique
+        # constraint
+        table = TableHandler(Transaction().cursor, cls, module_name)
+        table.index_action(['prestashop_combination_id', 'channel'], 'add')
+
     @classmethod
     def __setup__(cls):
         "Setup"
@@ -298,45 +313,92 @@ class ProductPrestashop(ModelSQL, ModelView):
         :param records: List of active records
         """
         super(ProductPrestashop, cls).validate(records)
-        for record in records:
-            record.check_combination()
+        cls.check_combinations(records)
 
     def check_combination(self):
-        """Performs two checks
+        """Performs the checks of `check_combinations` on this record alone
+        """
+        self.check_combinations([self])
+        return True
 
-        1. Checks that this combination is unique within the template.
-        2. Checks that this combination is unique throughout the channel if
+    @classmethod
+    def check_combinations(cls, records):
+        """Performs two checks over the whole batch of records with grouped
+        queries, instead of searching once per record.
+
+        1. Checks that the combinations are unique within the template.
+        2. Checks that the combinations are unique throughout the channel if
            the combination id from prestashop is non zero.
+
+        :param records: List of active records
         """
-        # Check that this combination is unique within the template
-        if len(ProductPrestashop.search([
-            ('prestashop_combination_id', '=', self.prestashop_combination_id),
-            ('channel', '=', self.channel.id),
-            ('product.template', '=', self.product.template.id)
-        ])) > 1:
-            self.raise_user_error(
-                'duplicate_combination', {
-                    'combination_id': self.prestashop_combination_id,
-                    'template': self.product.template.name,
-                    'channel': self.channel.prestashop_url,
-                }
-            )
-        # Check that this combination is unique throughout the channel if
-        # the combination id from prestashop is non zero
-        if self.prestashop_combination_id != 0 and len(
-            ProductPrestashop.search([
-                ('prestashop_combination_id', '=',
-                    self.prestashop_combination_id),
-                ('channel', '=', self.channel.id),
-            ])
-        ) > 1:
-            self.raise_user_error(
-                'duplicate_combination_across_channel', {
-                    'combination_id': self.prestashop_combination_id,
-                    'channel': self.channel.prestashop_url,
-                }
-            )
-        return True
+        Product = Pool().get('product.product')
+
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        product = Product.__table__()
+
+        by_template = {}
+        by_channel = {}
+        for record in records:
+            by_template[(
+                record.prestashop_combination_id, record.channel.id,
+                record.product.template.id
+            )] = record
+            by_channel[(
+                record.prestashop_combination_id, record.channel.id
+            )] = record
+
+        combination_ids = list(set(key[0] for key in by_channel))
+        channel_ids = list(set(key[1] for key in by_channel))
+        for i in range(0, len(combination_ids), cursor.IN_MAX):
+            sub_ids = combination_ids[i:i + cursor.IN_MAX]
+            in_batch = table.prestashop_combination_id.in_(sub_ids)
+            in_batch &= table.channel.in_(channel_ids)
+
+            # Check that the combinations are unique within the template
+            cursor.execute(*table.join(
+                product, condition=table.product == product.id
+            ).select(
+                table.prestashop_combination_id, table.channel,
+                product.template,
+                where=in_batch,
+                group_by=[
+                    table.prestashop_combination_id, table.channel,
+                    product.template,
+                ],
+                having=Count(table.id) > 1
+            ))
+            for key in cursor.fetchall():
+                record = by_template.get(tuple(key))
+                if record is None:
+                    continue
+                record.raise_user_error(
+                    'duplicate_combination', {
+                        'combination_id': record.prestashop_combination_id,
+                        'template': record.product.template.name,
+                        'channel': record.channel.prestashop_url,
+                    }
+                )
+
+            # Check that the combinations are unique throughout the channel
+            # if the combination id from prestashop is non zero
+            cursor.execute(*table.select(
+                table.prestashop_combination_id, table.channel,
+                where=in_batch & (table.prestashop_combination_id != 0),
+                group_by=[table.prestashop_combination_id, table.channel],
+                having=Count(table.id) > 1
+            ))
+            for key in cursor.fetchall():
+                record = by_channel.get(tuple(key))
+                if record is None:
+                    continue
+                record.raise_user_error(
+                    'duplicate_combination_across_channel', {
+                        'combination_id': record.prestashop_combination_id,
+                        'channel': record.channel.prestashop_url,
+                    }
+                )
 
 
 class Product:
@@ -379,10 +441,10 @@ class Product:
         channel = SaleChannel(Transaction().context['current_channel'])
         channel.validate_prestashop_channel()
 
-        client = channel.get_prestashop_client()
-
         template = Template.find_or_create_using_ps_data(
-            client.products.get(combination_record.id_product.pyval)
+            channel.get_prestashop_record(
+                'products', combination_record.id_product.pyval
+            )
         )
         product, = cls.create([{
             'template': template.id,
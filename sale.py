@@ -5,18 +5,56 @@
     :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
-from datetime import datetime
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
 from decimal import Decimal
 
-import pytz
-
+from lxml.builder import E
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 
+from webservice import map_concurrently
+
 
 __all__ = ['Sale', 'SaleLine', 'SiteOrderState']
 __metaclass__ = PoolMeta
+logger = logging.getLogger('prestashop')
+
+
+@contextmanager
+def savepoint(name):
+    """Run the block within a savepoint, so that only the changes of the
+    block are rolled back when it raises. The records cached since the
+    savepoint are cleared on rollback, as they may hold values rolled back.
+
+    Savepoints are only used on postgresql. SQLite commits the pending
+    changes on a savepoint, so the block is run as is there and nothing is
+    rolled back when it raises.
+
+    :param name: Name of the savepoint
+    """
+    if backend.name() != 'postgresql':
+        yield
+        return
+
+    transaction = Transaction()
+    cursor = transaction.cursor
+    cursor.execute('SAVEPOINT %s' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT %s' % name)
+        cursor.execute('RELEASE SAVEPOINT %s' % name)
+        for cache in cursor.cache.itervalues():
+            cache.clear()
+        # The local caches of the records are cleared once the counter
+        # changes
+        transaction.counter += 1
+        raise
+    cursor.execute('RELEASE SAVEPOINT %s' % name)
 
 
 class SiteOrderState(ModelSQL, ModelView):
@@ -201,6 +239,26 @@ class Sale:
     __name__ = 'sale.sale'
 
     prestashop_id = fields.Integer('Prestashop ID', readonly=True)
+    prestashop_date_upd = fields.DateTime(
+        'Prestashop Last Update', readonly=True,
+        help='Time of the last update of the order on prestashop, as seen '
+        'by the last import'
+    )
+    prestashop_current_state = fields.Integer(
+        'Prestashop Current State', readonly=True,
+        help='Prestashop ID of the state of the order, as seen by the last '
+        'import or set by the last export'
+    )
+    prestashop_export_failed = fields.Boolean(
+        'Prestashop Export Failed', readonly=True,
+        help='The state of the sale could not be exported by the last export '
+        'and is to be exported again by the next one'
+    )
+
+    @staticmethod
+    def default_prestashop_export_failed():
+        "Return False"
+        return False
 
     @classmethod
     def __setup__(cls):
@@ -240,13 +298,121 @@ class Sale:
         :param order_record: Objectified XML record sent by pystashop
         :returns: Active record of created sale
         """
+        sale_data, ps_order_state = cls.get_sale_data_using_ps_data(
+            order_record
+        )
+        sale, = cls.create([sale_data])
+
+        failures = cls.process_created_using_ps_data(
+            [sale], [order_record], [ps_order_state]
+        )
+        if failures:
+            raise failures[0][1]
+
+        return sale
+
+    @classmethod
+    def create_all_using_ps_data(cls, order_records):
+        """Create the orders from a list of order records sent by prestashop
+        client, with a single call to create for all of them.
+
+        Each order is handled within a savepoint on postgresql, so that an
+        order which fails does not roll back the others. The failed orders
+        are returned along with the exception raised for each of them. A sale
+        whose state could not be processed is deleted, for its order to be
+        imported again when the import is retried.
+
+        :param order_records: List of objectified XML records sent by pystashop
+        :returns: A tuple of the list of active records of created sales and
+                  the list of (prestashop ID, exception) for failed orders
+        """
+        sales_data, records, order_states, failures = [], [], [], []
+        for order_record in order_records:
+            try:
+                with savepoint('prestashop_order'):
+                    sale_data, ps_order_state = \
+                        cls.get_sale_data_using_ps_data(order_record)
+            except Exception as exception:
+                failures.append((order_record.id.pyval, exception))
+                continue
+            sales_data.append(sale_data)
+            records.append(order_record)
+            order_states.append(ps_order_state)
+
+        if not sales_data:
+            return [], failures
+
+        sales, records, order_states, create_failures = \
+            cls.create_sales_using_ps_data(sales_data, records, order_states)
+        failures.extend(create_failures)
+
+        process_failures = cls.process_created_using_ps_data(
+            sales, records, order_states
+        )
+        if process_failures:
+            failed_sales = [sale for sale, _ in process_failures]
+            failures.extend(
+                (sale.prestashop_id, exception)
+                for sale, exception in process_failures
+            )
+            sales = [sale for sale in sales if sale not in failed_sales]
+            cls.delete(failed_sales)
+
+        return sales, failures
+
+    @classmethod
+    def create_sales_using_ps_data(
+        cls, sales_data, order_records, order_states
+    ):
+        """Create the sales from their values with a single call to create.
+        If it fails, the sales are created one by one to find the ones which
+        fail.
+
+        :param sales_data: List of dictionaries of sale values
+        :param order_records: List of the corresponding objectified XML
+                              records sent by pystashop
+        :param order_states: List of the corresponding site order states
+        :returns: A tuple of the list of active records of created sales, the
+                  lists of their order records and site order states and the
+                  list of (prestashop ID, exception) for failed orders
+        """
+        try:
+            with savepoint('prestashop_sales'):
+                sales = cls.create(sales_data)
+            return sales, order_records, order_states, []
+        except Exception:
+            # Create the sales one by one to find the ones which fail
+            pass
+
+        sales, created_records, created_states, failures = [], [], [], []
+        for sale_data, order_record, ps_order_state in zip(
+                sales_data, order_records, order_states):
+            try:
+                with savepoint('prestashop_order'):
+                    sale, = cls.create([sale_data])
+            except Exception as exception:
+                failures.append((order_record.id.pyval, exception))
+                continue
+            sales.append(sale)
+            created_records.append(order_record)
+            created_states.append(ps_order_state)
+        return sales, created_records, created_states, failures
+
+    @classmethod
+    def get_sale_data_using_ps_data(cls, order_record):
+        """Return the values to create a sale from the order record sent by
+        prestashop client. The party, addresses and products of the order are
+        found or created on the way.
+
+        :param order_record: Objectified XML record sent by pystashop
+        :returns: A tuple of the dictionary of sale values and the site order
+                  state corresponding to the state of the order
+        """
         Party = Pool().get('party.party')
         Address = Pool().get('party.address')
         Line = Pool().get('sale.line')
         SaleChannel = Pool().get('sale.channel')
         Currency = Pool().get('currency.currency')
-        SiteOrderState = Pool().get('prestashop.site.order_state')
-        ChannelException = Pool().get('channel.exception')
 
         channel = SaleChannel(Transaction().context['current_channel'])
 
@@ -257,24 +423,28 @@ class Sale:
             cls.raise_user_error('prestashop_site_not_found')
 
         party = Party.find_or_create_using_ps_data(
-            client.customers.get(order_record.id_customer.pyval)
+            channel.get_prestashop_record(
+                'customers', order_record.id_customer.pyval
+            )
         )
 
         # Get the sale date and convert the time to UTC from the application
         # timezone set on channel
-        sale_time = datetime.strptime(
-            order_record.date_add.pyval, '%Y-%m-%d %H:%M:%S'
+        sale_time_utc = channel.get_utc_time_using_ps_time(
+            order_record.date_add.pyval
         )
-        channel_tz = pytz.timezone(channel.prestashop_timezone)
-        sale_time_utc = pytz.utc.normalize(channel_tz.localize(sale_time))
 
         inv_address = Address.find_or_create_for_party_using_ps_data(
             party,
-            client.addresses.get(order_record.id_address_invoice.pyval),
+            channel.get_prestashop_record(
+                'addresses', order_record.id_address_invoice.pyval
+            ),
         )
         ship_address = Address.find_or_create_for_party_using_ps_data(
             party,
-            client.addresses.get(order_record.id_address_delivery.pyval),
+            channel.get_prestashop_record(
+                'addresses', order_record.id_address_delivery.pyval
+            ),
         )
         sale_data = {
             'reference': str(order_record.id.pyval),
@@ -284,12 +454,16 @@ class Sale:
             'invoice_address': inv_address.id,
             'shipment_address': ship_address.id,
             'prestashop_id': order_record.id.pyval,
+            'prestashop_date_upd': channel.get_utc_time_using_ps_time(
+                order_record.date_upd.pyval
+            ),
+            'prestashop_current_state': order_record.current_state.pyval,
             'currency': Currency.get_using_ps_id(
                 order_record.id_currency.pyval
             ).id,
         }
 
-        ps_order_state = SiteOrderState.search_using_ps_id(
+        ps_order_state = channel.get_prestashop_order_state(
             order_record.current_state.pyval
         )
 
@@ -314,54 +488,140 @@ class Sale:
 
         sale_data['lines'] = [('create', lines_data)]
 
-        sale, = cls.create([sale_data])
+        return sale_data, ps_order_state
 
-        # Create channel exception if order total does not match
-        if sale.total_amount != Decimal(
-            str(order_record.total_paid_tax_excl)
-        ):
-            ChannelException.create([{
-                'origin': '%s,%s' % (sale.__name__, sale.id),
-                'log': 'Order total does not match.',
-                'channel': sale.channel.id,
-            }])
+    @classmethod
+    def process_created_using_ps_data(cls, sales, order_records, order_states):
+        """Process the sales just created from the order records as per the
+        state of the orders on prestashop. A channel exception is created
+        instead for the sales whose total does not match the order total.
+
+        :param sales: List of active records of the sales created
+        :param order_records: List of the corresponding objectified XML
+                              records sent by pystashop
+        :param order_states: List of the corresponding site order states
+        :returns: List of (active record of sale, exception) for the sales
+                  whose state could not be processed
+        """
+        ChannelException = Pool().get('channel.exception')
 
-            return sale
+        exceptions = []
+        sales_to_process, states_to_process = [], []
+        for sale, order_record, ps_order_state in zip(
+                sales, order_records, order_states):
+            # Create channel exception if order total does not match
+            if sale.total_amount != Decimal(
+                str(order_record.total_paid_tax_excl)
+            ):
+                exceptions.append({
+                    'origin': '%s,%s' % (sale.__name__, sale.id),
+                    'log': 'Order total does not match.',
+                    'channel': sale.channel.id,
+                })
+                continue
 
-        sale.process_state_using_ps_data(ps_order_state)
+            sales_to_process.append(sale)
+            states_to_process.append(ps_order_state)
 
-        return sale
+        if exceptions:
+            ChannelException.create(exceptions)
+
+        return cls.process_states_using_ps_data(
+            sales_to_process, states_to_process
+        )
+
+    def is_changed_on_prestashop(self, order_record):
+        """Check if the order was updated on prestashop since it was last
+        seen by an import. Only the update time and the state of the order
+        are compared, so no other record has to be fetched to tell.
+
+        :param order_record: Objectified XML record sent by pystashop
+        :returns: True if the order changed since the last import
+        """
+        date_upd = self.channel.get_utc_time_using_ps_time(
+            order_record.date_upd.pyval
+        )
+        if self.prestashop_date_upd != date_upd:
+            return True
+        return (
+            self.prestashop_current_state != order_record.current_state.pyval
+        )
 
     def process_state_using_ps_data(self, order_state):
         """Process Sale state as per the current state
 
         :param order_state: Site order state corresponding to ps order state
         """
-        Sale = Pool().get('sale.sale')
+        failures = self.process_states_using_ps_data([self], [order_state])
+        if failures:
+            raise failures[0][1]
 
-        # Do not process sale if sale has exception
-        if self.has_channel_exception:
-            return
+    @classmethod
+    def process_states_using_ps_data(cls, sales, order_states):
+        """Process the state of the sales as per the corresponding order
+        states. The sales are grouped by the tryton state to reach and each
+        transition is run once per group.
+
+        The transitions of a group are run within a savepoint on postgresql.
+        If they fail, they are run again for one sale at a time, so that only
+        the sales which fail are left unprocessed.
+
+        :param sales: List of active records of sales
+        :param order_states: List of the corresponding site order states
+        :returns: List of (active record of sale, exception) for the sales
+                  whose state could not be processed
+        """
+        sales_by_state = defaultdict(list)
+        for sale, order_state in zip(sales, order_states):
+            # Do not process sale if sale has exception
+            if sale.has_channel_exception:
+                continue
+            sales_by_state[order_state.order_state].append(sale)
+
+        failures = []
+        for state, sales_to_process in sales_by_state.iteritems():
+            try:
+                with savepoint('prestashop_state'):
+                    cls.transition_using_ps_state(sales_to_process, state)
+                continue
+            except Exception:
+                # Process the sales one by one to find the ones which fail
+                pass
 
-        self.channel.get_prestashop_client()
+            for sale in sales_to_process:
+                try:
+                    with savepoint('prestashop_state'):
+                        cls.transition_using_ps_state([sale], state)
+                except Exception as exception:
+                    failures.append((sale, exception))
 
+        return failures
+
+    @classmethod
+    def transition_using_ps_state(cls, sales, state):
+        """Run the transitions which bring the sales to the given state
+
+        :param sales: List of active records of sales
+        :param state: Tryton state of the sales mapped to the prestashop
+                      state, eg: `sale.done`
+        """
         # Cancel the order if its cancelled on prestashop
-        if order_state.order_state == 'sale.cancel':
-            Sale.cancel([self])
+        if state == 'sale.cancel':
+            cls.cancel(sales)
             return
 
         # Confirm and process the order in any other case
-        Sale.quote([self])
-        Sale.confirm([self])
+        cls.quote(sales)
+        cls.confirm(sales)
 
-        if order_state.order_state != 'sale.confirmed':
+        if state != 'sale.confirmed':
             # XXX: To mark sale as Done, sale must be in Processing state
             # as marking sale as Done is part of transition workflow now,
             # which allows only processed sale to be marked as Done.
             # But not sure if calling proceed before process is the right
             # way to do.
-            Sale.proceed([self])
-            Sale.process([self])
+            cls.proceed(sales)
+            cls.process(sales)
 
     @classmethod
     def get_order_using_ps_data(cls, order_record):
@@ -380,34 +640,133 @@ class Sale:
 
     def export_status_to_ps(self):
         """Update the status of this order in prestashop based on the order
-        state in Tryton.
+        state in Tryton. Nothing is sent if the order is already in that
+        state on prestashop.
+
+        """
+        orders, failures = self.export_statuses_to_ps([self])
+        if failures:
+            raise failures[0][1]
+        return orders.get(self.id)
 
+    @classmethod
+    def export_statuses_to_ps(cls, sales):
+        """Update the status of the orders in prestashop based on the order
+        state of the sales in Tryton. The updates are sent concurrently, up
+        to the maximum number of concurrent requests set on the channel.
+        The orders already in the state on prestashop are skipped.
+
+        An order which could not be updated is logged and returned along
+        with the exception raised, the others are updated anyway. Its sale is
+        flagged for the next exports to retry it, until the state of the
+        order is up to date.
+
+        :param sales: List of active records of sales of the same channel
+        :returns: A tuple of the dictionary of sale ID and the order history
+                  record created and the list of (sale ID, exception) for the
+                  orders which could not be updated
         """
-        SiteOrderState = Pool().get('prestashop.site.order_state')
+        if not sales:
+            return {}, []
 
-        client = self.channel.get_prestashop_client()
+        channel = sales[0].channel
+        client = channel.get_prestashop_client()
 
-        def get_state(state_id):
-            "Returns the id of prestashop state corresponding to tryton state"
-            return client.order_states.get_list(
-                filters={'id': state_id}, as_ids=True
-            )[0]
+        updates = [
+            (sale.id, sale.prestashop_id, prestashop_state)
+            for sale, prestashop_state in
+            cls.get_prestashop_states_to_export(sales)
+        ]
 
-        # Get the corresponding PS state from channel order states as the state
-        # of state
-        channel_order_state = SiteOrderState.search([
-            ('order_state', '=', 'sale.' + self.state)
-        ])
-        if not channel_order_state:
-            return
-        else:
-            prestashop_state = get_state(channel_order_state[0].prestashop_id)
+        def update_order(update):
+            "Update the state of an order, run in a worker thread"
+            sale_id, order_id, prestashop_state = update
+            # Adding an entry to the history of the order changes its
+            # state, without sending the whole order back and forth
+            order_history = E.order_history(
+                E.id_order(str(order_id)),
+                E.id_order_state(str(prestashop_state)),
+            )
+            try:
+                return client.order_histories.create(order_history), None
+            except Exception as exception:
+                return None, exception
+
+        results = map_concurrently(
+            update_order, updates, channel.prestashop_max_connections or 1
+        )
+
+        orders, failures = {}, []
+        exported = defaultdict(list)
+        for (sale_id, order_id, prestashop_state), (order, exception) in zip(
+                updates, results):
+            if exception is not None:
+                logger.warning(
+                    'State of order %s of channel %s could not be exported: '
+                    '%s', order_id, channel.id, exception
+                )
+                failures.append((sale_id, exception))
+                continue
+            orders[sale_id] = order
+            exported[prestashop_state].append(sale_id)
+
+        # Remember the states exported, for the sales to be skipped until
+        # their state changes again
+        for prestashop_state, sale_ids in exported.iteritems():
+            cls.write(cls.browse(sale_ids), {
+                'prestashop_current_state': prestashop_state,
+            })
+
+        failed_ids = set(sale_id for sale_id, _ in failures)
+        to_retry = [
+            sale for sale in sales
+            if sale.id in failed_ids and not sale.prestashop_export_failed
+        ]
+        retried = [
+            sale for sale in sales
+            if sale.id not in failed_ids and sale.prestashop_export_failed
+        ]
+        if to_retry:
+            cls.write(to_retry, {'prestashop_export_failed': True})
+        if retried:
+            cls.write(retried, {'prestashop_export_failed': False})
+        return orders, failures
 
-        order = client.orders.get(self.prestashop_id)
-        order.current_state = prestashop_state
-        result = client.orders.update(order.id, order)
+    @classmethod
+    def get_prestashop_states_to_export(cls, sales):
+        """Return the prestashop state to be exported for each of the sales,
+        as per their state in tryton. The sales whose state is not mapped to
+        any prestashop state are left out, and so are the ones whose order is
+        already in a prestashop state mapped to their state.
+
+        :param sales: List of active records of sales of the same channel
+        :returns: List of tuples of sale and prestashop order state ID
+        """
+        channel = sales[0].channel
+
+        # Map the tryton states to the PS states using the channel order
+        # states, loaded once for all the sales. The first order state found
+        # is exported when several ones map to the same tryton state.
+        prestashop_states, tryton_states = {}, {}
+        for order_state in channel.prestashop_order_states:
+            prestashop_states.setdefault(
+                order_state.order_state, order_state.prestashop_id
+            )
+            tryton_states[order_state.prestashop_id] = order_state.order_state
 
-        return result.order
+        states_to_export = []
+        for sale in sales:
+            tryton_state = 'sale.' + sale.state
+            prestashop_state = prestashop_states.get(tryton_state)
+            if prestashop_state is None:
+                continue
+            if tryton_states.get(sale.prestashop_current_state) == \
+                    tryton_state:
+                # The order is already in a state mapped to this one on
+                # prestashop
+                continue
+            states_to_export.append((sale, prestashop_state))
+        return states_to_export
 
 
 class SaleLine:
@@ -426,12 +785,12 @@ class SaleLine:
         channel = SaleChannel(Transaction().context['current_channel'])
         channel.validate_prestashop_channel()
 
-        client = channel.get_prestashop_client()
-
         # Import product
         product = channel.import_product(order_row_record)
 
-        order_details = client.order_details.get(order_row_record.id.pyval)
+        order_details = channel.get_prestashop_record(
+            'order_details', order_row_record.id.pyval
+        )
 
         # FIXME: The number of digits handled in unit price should actually
         # from sale currency but the sale is not created yet.
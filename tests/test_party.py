@@ -155,6 +155,15 @@ class TestParty(BaseTestCase):
                     address.country.id
                 )
 
+                # The address is indexed with the fingerprint of the
+                # prestashop data
+                self.assertEqual(
+                    address.prestashop_fingerprint,
+                    self.Address.get_prestashop_fingerprint_using_ps_data(
+                        address_data
+                    )
+                )
+
                 # Find or create the same address, it should not create a new
                 # one
                 address = \
@@ -234,6 +243,87 @@ class TestParty(BaseTestCase):
                     ('channel', '=', self.alt_channel.id)
                 ])), 0)
 
+    def test_0030_contact_mechanisms_find_or_create(self):
+        """Test the contact mechanisms are only created if no mechanism of
+        the same party, type and value exists
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with txn.set_context(
+                current_channel=self.channel.id, ps_test=True
+            ):
+                self.setup_channels()
+
+                party_a, party_b = self.Party.create([{
+                    'name': 'Party A',
+                    'contact_mechanisms': [('create', [{
+                        'type': 'email',
+                        'value': 'a@example.com',
+                    }, {
+                        'type': 'phone',
+                        'value': '1234',
+                    }])],
+                }, {
+                    'name': 'Party B',
+                    'contact_mechanisms': [('create', [{
+                        'type': 'email',
+                        'value': 'b@example.com',
+                    }])],
+                }])
+
+                def get_mechanisms():
+                    return sorted(
+                        (mechanism.party.id, mechanism.type, mechanism.value)
+                        for mechanism in self.ContactMechanism.search([
+                            ('party', 'in', [party_a.id, party_b.id]),
+                        ])
+                    )
+
+                mechanisms = self.ContactMechanism.find_or_create_using_dict([
+                    # Exists already
+                    {'party': party_a.id, 'type': 'email',
+                        'value': 'a@example.com'},
+                    # The party, type and value all exist, but not together
+                    {'party': party_a.id, 'type': 'email',
+                        'value': 'b@example.com'},
+                    {'party': party_b.id, 'type': 'phone', 'value': '1234'},
+                    # Repeated in the data
+                    {'party': party_b.id, 'type': 'email',
+                        'value': 'a@example.com'},
+                    {'party': party_b.id, 'type': 'email',
+                        'value': 'a@example.com'},
+                ])
+
+                self.assertEqual(
+                    sorted(
+                        (mechanism.party.id, mechanism.type, mechanism.value)
+                        for mechanism in mechanisms
+                    ), [
+                        (party_a.id, 'email', 'b@example.com'),
+                        (party_b.id, 'email', 'a@example.com'),
+                        (party_b.id, 'phone', '1234'),
+                    ]
+                )
+                self.assertEqual(get_mechanisms(), sorted([
+                    (party_a.id, 'email', 'a@example.com'),
+                    (party_a.id, 'email', 'b@example.com'),
+                    (party_a.id, 'phone', '1234'),
+                    (party_b.id, 'email', 'a@example.com'),
+                    (party_b.id, 'email', 'b@example.com'),
+                    (party_b.id, 'phone', '1234'),
+                ]))
+
+                # Nothing is created again
+                self.assertEqual(
+                    self.ContactMechanism.find_or_create_using_dict([
+                        {'party': party_b.id, 'type': 'phone',
+                            'value': '1234'},
+                    ]), []
+                )
+                self.assertEqual(len(get_mechanisms()), 6)
+
 
 def suite():
     "Prestashop Party test suite"
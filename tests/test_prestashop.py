@@ -20,7 +20,7 @@ DIR = os.path.abspath(
 if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
-from lxml import objectify
+from lxml import etree, objectify
 import unittest
 
 import trytond
@@ -61,6 +61,103 @@ def get_objectified_xml(resource, filename):
     return objectify.fromstring(open(file_path).read()).getchildren()[0]
 
 
+def get_flat_values(record):
+    """Return the tag, value and type of the value of each field of the
+    objectified XML record which is not a nested record.
+    """
+    return [
+        (field.tag, field.pyval, type(field.pyval))
+        for field in record.iterchildren() if not field.countchildren()
+    ]
+
+
+def get_xml_content(resource, filename):
+    """Reads the xml file from the filesystem and returns its content, as
+    it would be sent by prestashop
+
+    :param resource: The prestashop resource for which the file has to be
+                     fetched.
+    :param filename: The name of the file to be fetched without `.xml`
+                     extension.
+    :returns: Content of the file read.
+    """
+    root_xml_folder = pkg_resources.resource_filename('mockstashop', 'xml')
+    file_path = os.path.join(
+        root_xml_folder, PS_VERSION, resource, str(filename)
+    ) + '.xml'
+    return open(file_path).read()
+
+
+def get_xml_list_content(resource, filenames):
+    """Return the content of a list of records of the resource, as it would
+    be sent by prestashop
+
+    :param resource: The prestashop resource of the records
+    :param filenames: The names of the files of the records
+    :returns: Content of the list
+    """
+    root = etree.Element('prestashop')
+    records = etree.SubElement(root, resource)
+    for filename in filenames:
+        records.extend(etree.fromstring(
+            get_xml_content(resource, filename)
+        ).getchildren())
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+
+#: Content of a list of records sent by prestashop when nothing matches
+EMPTY_LIST_CONTENT = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<prestashop><records/></prestashop>'
+)
+
+
+def get_params_by_resource(session):
+    """Return the parameters of the requests recorded by a fake session by
+    name of the resource requested
+    """
+    return dict(
+        (url.rsplit('/', 1)[1], kwargs['params'])
+        for url, kwargs in session.requests
+    )
+
+
+class FakeResponse(object):
+    """A response of the webservice, sent without any network access. The
+    body is streamed in pieces of `split_size` bytes.
+    """
+
+    def __init__(self, content, split_size=None):
+        self.status_code = 200
+        self.content = content
+        self.split_size = split_size or len(content)
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for index in xrange(0, len(self.content), self.split_size):
+            yield self.content[index:index + self.split_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """A session which records the requests sent and answers all of them
+    with the same content.
+    """
+
+    def __init__(self, content, split_size=None):
+        self.content = content
+        self.split_size = split_size
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append((url, kwargs))
+        return FakeResponse(self.content, self.split_size)
+
+
 class BaseTestCase(unittest.TestCase):
     "Base Test case"
 
@@ -545,6 +642,434 @@ class TestPrestashop(BaseTestCase):
 
             txn.cursor.rollback()
 
+    def test_0060_import_mappings(self):
+        """Test the caching of countries, states and currencies in bulk
+        """
+        Country = POOL.get('country.country')
+        Subdivision = POOL.get('country.subdivision')
+        Currency = POOL.get('currency.currency')
+
+        # The mock client has no list of these resources, so the records
+        # the mapping import would fetch are read from the files instead
+        country_records = [
+            get_objectified_xml('countries', ps_id) for ps_id in (8, 21, 110)
+        ]
+        state_records = [get_objectified_xml('states', 1)]
+        currency_records = [get_objectified_xml('currencies', 1)]
+
+        def cache_records():
+            return Country.cache_prestashop_records(country_records) + \
+                Subdivision.cache_prestashop_records(state_records) + \
+                Currency.cache_prestashop_records(currency_records)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(ps_test=True):
+                self.setup_channels()
+
+                self.assertEqual(len(self.CountryPrestashop.search([])), 0)
+
+                with Transaction().set_context(
+                    current_channel=self.channel.id
+                ):
+                    cache_records()
+
+                # The country of the address is cached without having to
+                # look it up on prestashop
+                ps_country_id = get_objectified_xml(
+                    'addresses', 2
+                ).id_country.pyval
+                self.assertEqual(len(self.CountryPrestashop.search([
+                    ('channel', '=', self.channel.id),
+                    ('prestashop_id', '=', ps_country_id),
+                ])), 1)
+
+                # Nothing is cached again on another import
+                with Transaction().set_context(
+                    current_channel=self.channel.id
+                ):
+                    self.assertEqual(cache_records(), [])
+
+                # Nothing should be cached for alt_channel
+                self.assertEqual(len(self.CountryPrestashop.search([
+                    ('channel', '=', self.alt_channel.id)
+                ])), 0)
+
+            txn.cursor.rollback()
+
+    def test_0065_lookup_caches(self):
+        """Test the tryton records looked up by prestashop ID are cached,
+        until the mappings change
+        """
+        Country = POOL.get('country.country')
+        Currency = POOL.get('currency.currency')
+        CountryPrestashop = POOL.get('country.country.prestashop')
+        CurrencyPrestashop = POOL.get('currency.currency.prestashop')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(ps_test=True):
+                self.setup_channels()
+
+            france, = Country.search([('code', '=', 'FR')])
+            united_states, = Country.search([('code', '=', 'US')])
+            euro, = Currency.create([{
+                'name': 'Euro',
+                'code': 'EUR',
+                'symbol': 'EUR',
+            }])
+
+            for Model, Mapping, field, record, other_record in [
+                (Country, CountryPrestashop, 'country', france,
+                    united_states),
+                (Currency, CurrencyPrestashop, 'currency', self.usd, euro),
+            ]:
+                mapping, = Mapping.create([{
+                    field: record.id,
+                    'channel': self.channel.id,
+                    'prestashop_id': 1000,
+                }])
+
+                with Transaction().set_context(
+                    current_channel=self.channel.id
+                ):
+                    self.assertEqual(Model.get_using_ps_id(1000), record)
+
+                    # The mapping is changed in the database alone, so the
+                    # record is still read from the cache and not searched
+                    table = Mapping.__table__()
+                    Transaction().cursor.execute(*table.update(
+                        columns=[getattr(table, field)],
+                        values=[other_record.id],
+                        where=table.id == mapping.id
+                    ))
+                    self.assertEqual(Model.get_using_ps_id(1000), record)
+
+                    # Writing the mapping clears the cache
+                    Mapping.write([Mapping(mapping.id)], {
+                        field: other_record.id,
+                    })
+                    self.assertEqual(
+                        Model.get_using_ps_id(1000), other_record
+                    )
+
+                    # Deleting and creating mappings clear the cache
+                    Mapping.delete([mapping])
+                    self.assertIsNone(Mapping._get_using_ps_id_cache.get(
+                        (self.channel.id, 1000)
+                    ))
+
+                    Mapping.create([{
+                        field: record.id,
+                        'channel': self.channel.id,
+                        'prestashop_id': 1000,
+                    }])
+                    self.assertEqual(Model.get_using_ps_id(1000), record)
+                    Mapping.create([{
+                        field: record.id,
+                        'channel': self.alt_channel.id,
+                        'prestashop_id': 1000,
+                    }])
+                    self.assertIsNone(Mapping._get_using_ps_id_cache.get(
+                        (self.channel.id, 1000)
+                    ))
+
+    def test_0070_json_records(self):
+        """
+        Test the records read in JSON behave as the objectified XML records
+        """
+        from trytond.modules.prestashop.webservice import JSONRecord
+
+        order = JSONRecord({
+            'id': '1',
+            'reference': 'XKBKNABJK',
+            'total_paid_tax_excl': '12.500000',
+            'id_address_invoice': 0,
+            'associations': {
+                'order_rows': [
+                    {'id': '2', 'product_attribute_id': '0'},
+                    {'id': '3', 'product_attribute_id': '4'},
+                ],
+            },
+        })
+        xml_order = get_objectified_xml('orders', 1)
+
+        self.assertEqual(order.id.pyval, xml_order.id.pyval)
+        self.assertEqual(order.reference.pyval, 'XKBKNABJK')
+        self.assertEqual(
+            Decimal(str(order.total_paid_tax_excl)), Decimal('12.5')
+        )
+        self.assertFalse(order.id_address_invoice)
+        self.assertEqual(
+            [row.product_attribute_id.pyval for row in
+                order.associations.order_rows.iterchildren()],
+            [0, 4]
+        )
+        self.assertRaises(AttributeError, getattr, order, 'current_state')
+
+        product = JSONRecord({
+            'name': [
+                {'id': '1', 'value': 'T-Shirt'},
+                {'id': '2', 'value': 'Camiseta'},
+            ],
+        })
+        name_in_langs = product.name.getchildren()
+        self.assertEqual(
+            [(name.get('id'), name.pyval) for name in name_in_langs],
+            [('1', 'T-Shirt'), ('2', 'Camiseta')]
+        )
+
+    def test_0080_pooled_session(self):
+        """
+        Test the prestashop client sends its requests through the pooled
+        session of the site
+        """
+        from trytond.modules.prestashop import webservice
+
+        url, key = 'http://pooled.example.com/', 'XXXX'
+        client = webservice.get_client(1, url, key)
+        self.assertIs(client.session, webservice.get_session(url, key))
+        self.assertIs(webservice.get_client(1, url, key), client)
+
+        session = FakeSession(get_xml_content('orders', 1))
+        client = webservice.PooledPrestaShopWebservice(url, key, session)
+        order = client.orders.get(1)
+
+        self.assertEqual(order.id.pyval, 1)
+        self.assertEqual(
+            session.requests, [('http://pooled.example.com/api/orders/1', {})]
+        )
+
+    def test_0090_xml_streamed_records(self):
+        """
+        Test the records parsed as the response is streamed are the same as
+        the ones parsed from the whole response
+        """
+        from trytond.modules.prestashop.webservice import XMLWebservice
+
+        # A list of orders as sent by prestashop
+        root = etree.Element('prestashop')
+        orders = etree.SubElement(root, 'orders')
+        for order_id in (1, 2):
+            orders.extend(etree.fromstring(
+                get_xml_content('orders', order_id)
+            ).getchildren())
+        content = etree.tostring(
+            root, xml_declaration=True, encoding='UTF-8'
+        )
+        expected_orders = objectify.fromstring(content).orders.getchildren()
+
+        # The body is received in pieces which end in the middle of tags, or
+        # at once
+        for split_size in (7, None):
+            session = FakeSession(content, split_size)
+            client = XMLWebservice('http://stream.example.com', session)
+            orders = client.orders.get_list(display='full')
+
+            self.assertEqual(
+                session.requests, [('http://stream.example.com/api/orders', {
+                    'params': {'display': 'full'}, 'stream': True,
+                })]
+            )
+            self.assertEqual(
+                [order.id.pyval for order in orders], [1, 3]
+            )
+            for order, expected_order in zip(orders, expected_orders):
+                # Each record is detached from the list
+                self.assertIsNone(order.getparent())
+                self.assertEqual(
+                    get_flat_values(order), get_flat_values(expected_order)
+                )
+                self.assertEqual(
+                    map(get_flat_values,
+                        order.associations.order_rows.iterchildren()),
+                    map(get_flat_values,
+                        expected_order.associations.order_rows.iterchildren())
+                )
+
+        # A single record is parsed the same way
+        session = FakeSession(get_xml_content('orders', 1))
+        client = XMLWebservice('http://stream.example.com', session)
+        order = client.orders.get(1)
+        expected_order = get_objectified_xml('orders', 1)
+
+        self.assertEqual(
+            session.requests, [('http://stream.example.com/api/orders/1', {})]
+        )
+        self.assertEqual(
+            get_flat_values(order), get_flat_values(expected_order)
+        )
+        self.assertEqual(
+            map(get_flat_values,
+                order.associations.order_rows.iterchildren()),
+            map(get_flat_values,
+                expected_order.associations.order_rows.iterchildren())
+        )
+
+    def test_0100_prefetch_order_data(self):
+        """
+        Test the records needed to import a page of orders are fetched with
+        one request per resource
+        """
+        from trytond.modules.prestashop.webservice import XMLWebservice
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                self.SaleChannel.write([self.channel], {
+                    'prestashop_max_connections': 4,
+                })
+                channel = self.SaleChannel(self.channel.id)
+
+                # Both orders are of the same product and combination, but
+                # of different customers and addresses
+                orders = [
+                    get_objectified_xml('orders', 1),
+                    get_objectified_xml('orders', 2),
+                ]
+                orders[1].id_customer = 2
+                orders[1].id_address_invoice = 3
+
+                session = FakeSession(EMPTY_LIST_CONTENT)
+                client = XMLWebservice('http://prefetch.example.com', session)
+                record_cache = channel.prefetch_prestashop_order_data(
+                    client, orders
+                )
+                self.assertEqual(record_cache.channel_id, channel.id)
+
+                display_fields = channel.get_prestashop_display_fields()
+                params_by_resource = get_params_by_resource(session)
+                self.assertEqual(len(session.requests), 5)
+                self.assertEqual(params_by_resource, {
+                    'customers': {
+                        'filter[id]': '[1|2]',
+                        'display': '[%s]' % ','.join(
+                            display_fields['customers']
+                        ),
+                    },
+                    'addresses': {
+                        'filter[id]': '[2|3]',
+                        'display': '[%s]' % ','.join(
+                            display_fields['addresses']
+                        ),
+                    },
+                    'order_details': {
+                        'filter[id]': '[1|2]',
+                        'display': '[%s]' % ','.join(
+                            display_fields['order_details']
+                        ),
+                    },
+                    'combinations': {
+                        'filter[id]': '[11]',
+                        'display': '[%s]' % ','.join(
+                            display_fields['combinations']
+                        ),
+                    },
+                    'products': {
+                        'filter[id]': '[7]',
+                        'display': '[%s]' % ','.join(
+                            display_fields['products']
+                        ),
+                    },
+                })
+
+    def test_0110_prefetch_in_chunks(self):
+        """
+        Test the records are fetched in chunks of ids, and only the records
+        not fetched yet
+        """
+        from trytond.modules.prestashop.webservice import RecordCache, \
+            XMLWebservice
+
+        session = FakeSession(EMPTY_LIST_CONTENT)
+        client = XMLWebservice('http://prefetch.example.com', session)
+        record_cache = RecordCache(
+            1, client, max_workers=2, display={'customers': ['id', 'email']}
+        )
+        record_cache.chunk_size = 2
+
+        record_cache.prefetch('customers', [5, 1, 3, 2, 4, 1, None])
+        self.assertEqual(
+            sorted(
+                kwargs['params']['filter[id]']
+                for url, kwargs in session.requests
+            ),
+            ['[1|2]', '[3|4]', '[5]']
+        )
+        self.assertEqual(
+            set(
+                kwargs['params']['display']
+                for url, kwargs in session.requests
+            ),
+            set(['[id,email]'])
+        )
+        self.assertEqual(
+            set(url for url, kwargs in session.requests),
+            set(['http://prefetch.example.com/api/customers'])
+        )
+
+        # The records already fetched are not fetched again
+        session = FakeSession(get_xml_list_content('customers', [1]))
+        client = XMLWebservice('http://prefetch.example.com', session)
+        record_cache = RecordCache(1, client)
+        record_cache.prefetch('customers', [1])
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(
+            session.requests[0][1]['params']['display'], 'full'
+        )
+        self.assertEqual(record_cache.records['customers'].keys(), [1])
+
+        record_cache.prefetch('customers', [1])
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(record_cache.get('customers', 1).id.pyval, 1)
+        self.assertEqual(len(session.requests), 1)
+
+    def test_0120_prefetch_skips_mapped_products(self):
+        """
+        Test the products and combinations already mapped to tryton are not
+        fetched again
+        """
+        from trytond.modules.prestashop.webservice import XMLWebservice
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                self.Product.find_or_create_using_ps_data(
+                    get_objectified_xml('combinations', 11)
+                )
+                self.ProductTemplate.find_or_create_using_ps_data(
+                    get_objectified_xml('products', 7)
+                )
+
+                session = FakeSession(EMPTY_LIST_CONTENT)
+                client = XMLWebservice('http://prefetch.example.com', session)
+                self.channel.prefetch_prestashop_order_data(
+                    client, [get_objectified_xml('orders', 1)]
+                )
+
+                self.assertEqual(
+                    sorted(get_params_by_resource(session).keys()),
+                    ['addresses', 'customers', 'order_details']
+                )
+
 
 def suite():
     "Prestashop test suite"
@@ -171,6 +171,74 @@ class TestProduct(BaseTestCase):
                     ('channel', '=', self.alt_channel.id)
                 ])), 0)
 
+    def test_0030_duplicate_combinations(self):
+        """Test the combinations are unique within a template, and throughout
+        the channel, whether the duplicates are created at once or not
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                # The combinations are of two different products
+                product_1 = self.Product.find_or_create_using_ps_data(
+                    get_objectified_xml('combinations', 1)
+                )
+                product_5 = self.Product.find_or_create_using_ps_data(
+                    get_objectified_xml('combinations', 5)
+                )
+                self.assertNotEqual(product_1.template, product_5.template)
+
+                def create(combination_id, product):
+                    return {
+                        'prestashop_combination_id': combination_id,
+                        'channel': self.channel.id,
+                        'product': product.id,
+                    }
+
+                # Duplicates created at once
+                with self.assertRaises(UserError) as context_manager:
+                    self.ProductPrestashop.create([
+                        create(100, product_1), create(100, product_1),
+                    ])
+                self.assertIn(
+                    'exists for template', context_manager.exception.message
+                )
+
+                with self.assertRaises(UserError) as context_manager:
+                    self.ProductPrestashop.create([
+                        create(101, product_1), create(101, product_5),
+                    ])
+                self.assertIn(
+                    'exists in channel', context_manager.exception.message
+                )
+
+                # Duplicates of a combination created before
+                self.ProductPrestashop.create([create(200, product_1)])
+                with self.assertRaises(UserError) as context_manager:
+                    self.ProductPrestashop.create([create(200, product_1)])
+                self.assertIn(
+                    'exists for template', context_manager.exception.message
+                )
+
+                self.ProductPrestashop.create([create(300, product_1)])
+                with self.assertRaises(UserError) as context_manager:
+                    self.ProductPrestashop.create([create(300, product_5)])
+                self.assertIn(
+                    'exists in channel', context_manager.exception.message
+                )
+
+                # The same combination can be on another channel
+                self.ProductPrestashop.create([{
+                    'prestashop_combination_id': 300,
+                    'channel': self.alt_channel.id,
+                    'product': product_5.id,
+                }])
+
 
 def suite():
     "Prestashop Product test suite"
@@ -5,17 +5,80 @@
     :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
+from contextlib import contextmanager
+from datetime import datetime
 from decimal import Decimal
 import unittest
 
+from dateutil.relativedelta import relativedelta
+
 import trytond.tests.test_tryton
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 
+from mockstashop import MockstaShopWebservice
+
 from test_prestashop import get_objectified_xml, BaseTestCase
 
 
+class FakeOrderHistories(object):
+    """The order histories of the prestashop client, which keep the entries
+    created instead of sending them.
+    """
+
+    def __init__(self):
+        self.created = []
+
+    def create(self, xml):
+        self.created.append(xml)
+        return xml
+
+
+class FakeOrders(object):
+    """The orders of the prestashop client, which are filtered by ID and
+    limited in number as prestashop does. The filters of each request are
+    kept.
+    """
+
+    def __init__(self, orders):
+        self.orders = orders
+        self.requests = []
+        #: Number of the request which fails, as if the connection was lost
+        self.failing_request = None
+
+    def get_list(self, filters=None, limit=None, **kwargs):
+        filters = filters or {}
+        self.requests.append(dict(filters))
+        if len(self.requests) == self.failing_request:
+            raise Exception('Network error')
+
+        orders = self.orders
+        if 'id' in filters:
+            min_id, max_id = map(int, filters['id'].split(','))
+            orders = [
+                order for order in orders
+                if min_id <= order.id.pyval <= max_id
+            ]
+        if limit is not None:
+            orders = orders[:int(limit)]
+        return orders
+
+
+class FakeClient(MockstaShopWebservice):
+    """A mock prestashop client which creates order history entries and lists
+    the orders without sending them.
+    """
+
+    def __init__(self, url, key):
+        super(FakeClient, self).__init__(url, key)
+        self.order_histories = FakeOrderHistories()
+        self.orders = FakeOrders([
+            get_objectified_xml('orders', 1),
+            get_objectified_xml('orders', 2),
+        ])
+
+
 class TestSale(BaseTestCase):
     "Test Order > Sale integration"
 
@@ -94,9 +157,23 @@ class TestSale(BaseTestCase):
                     self.Sale.create_using_ps_data, order_data
                 )
 
+                # The state and update time of the order are stored, so that
+                # an unchanged order is not imported again
+                self.assertEqual(
+                    sale.prestashop_current_state,
+                    order_data.current_state.pyval
+                )
+                self.assertTrue(sale.prestashop_date_upd)
+                self.assertFalse(sale.is_changed_on_prestashop(order_data))
+
+                order_data.date_upd = '2099-01-01 00:00:00'
+                self.assertTrue(sale.is_changed_on_prestashop(order_data))
+
     def test_0013_order_import_delivered(self):
         """Import an order that has been delivered on PS
         """
+        SiteOrderState = POOL.get('prestashop.site.order_state')
+
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             # Call method to setup defaults
             self.setup_defaults()
@@ -113,6 +190,36 @@ class TestSale(BaseTestCase):
 
                 self.assertEqual(sale.state, 'done')
 
+                # Several prestashop states map to the state of the sale,
+                # including the one of the order, so nothing is exported
+                order_states = SiteOrderState.search([
+                    ('channel', '=', self.channel.id),
+                    ('prestashop_id', 'in', [
+                        4, order_data.current_state.pyval
+                    ]),
+                ])
+                self.assertEqual(len(order_states), 2)
+                SiteOrderState.write(order_states, {
+                    'order_state': 'sale.done',
+                })
+                sale = self.Sale(sale.id)
+                self.assertEqual(
+                    self.Sale.get_prestashop_states_to_export([sale]), []
+                )
+                self.assertIsNone(sale.export_status_to_ps())
+
+                # The state is exported once the order is in another state
+                self.Sale.write([sale], {
+                    'prestashop_current_state': 1,
+                })
+                sale = self.Sale(sale.id)
+                (exported_sale, prestashop_state), = \
+                    self.Sale.get_prestashop_states_to_export([sale])
+                self.assertEqual(exported_sale, sale)
+                self.assertIn(prestashop_state, [
+                    order_state.prestashop_id for order_state in order_states
+                ])
+
     def test_0016_order_import_canceled(self):
         """Import an order which was canceled on PS
         """
@@ -132,6 +239,142 @@ class TestSale(BaseTestCase):
 
                 self.assertEqual(sale.state, 'cancel')
 
+    def test_0017_order_import_processing_fails(self):
+        """Import several orders at once, where the state of one of them
+        cannot be processed
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order_1 = get_objectified_xml('orders', 1)
+                order_2 = get_objectified_xml('orders', 2)
+                # Both orders have to reach the same state to be processed
+                # together
+                order_2.current_state = order_1.current_state.pyval
+
+                transition_using_ps_state = \
+                    self.Sale.transition_using_ps_state
+
+                def fail_for_order_2(sales, state):
+                    if 2 in [sale.prestashop_id for sale in sales]:
+                        raise UserError('Transition failed')
+                    transition_using_ps_state(sales, state)
+
+                self.Sale.transition_using_ps_state = staticmethod(
+                    fail_for_order_2
+                )
+                try:
+                    sales, failures = self.Sale.create_all_using_ps_data([
+                        order_1, order_2,
+                    ])
+                finally:
+                    self.Sale.transition_using_ps_state = \
+                        transition_using_ps_state
+
+                # The other order of the group is processed, the failed one
+                # is left to be imported again
+                sale, = sales
+                self.assertEqual(sale.prestashop_id, 1)
+                self.assertEqual(sale.state, 'done')
+                self.assertEqual(len(failures), 1)
+                self.assertEqual(failures[0][0], 2)
+                self.assertEqual(len(self.Sale.search([
+                    ('channel', '=', self.channel.id)
+                ])), 1)
+
+    def test_0018_order_import_in_batch(self):
+        """Import several orders at once, where one of them fails
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                sales, failures = self.Sale.create_all_using_ps_data([
+                    get_objectified_xml('orders', 1),
+                    get_objectified_xml('orders', 2),
+                ])
+                self.assertEqual(len(sales), 2)
+                self.assertEqual(failures, [])
+                self.assertEqual(
+                    set(sale.state for sale in sales), set(['done', 'cancel'])
+                )
+
+                # Importing an order again fails alone without affecting the
+                # sales created before
+                sales, failures = self.Sale.create_all_using_ps_data([
+                    get_objectified_xml('orders', 1),
+                ])
+                self.assertEqual(sales, [])
+                self.assertEqual(len(failures), 1)
+                self.assertEqual(failures[0][0], 1)
+                self.assertEqual(len(self.Sale.search([
+                    ('channel', '=', self.channel.id)
+                ])), 2)
+
+    def test_0019_import_job_queue(self):
+        """Queue the orders which failed to be imported and retry them
+        """
+        ImportJob = POOL.get('prestashop.import.job')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order_data = get_objectified_xml('orders', 1)
+                sales, failures = self.Sale.create_all_using_ps_data(
+                    [order_data]
+                )
+                self.assertEqual(failures, [])
+
+                failures = [(1, Exception('Network error'))]
+                job, = ImportJob.enqueue(self.channel, failures)
+                self.assertEqual(job.state, 'pending')
+                self.assertEqual(job.attempts, 1)
+                self.assertEqual(job.last_error, 'Network error')
+
+                # Queuing the same order again does not add a job
+                self.assertEqual(
+                    ImportJob.enqueue(self.channel, failures), []
+                )
+
+                # A failed attempt is retried later
+                ImportJob.save_results([job], [], failures)
+                job = ImportJob(job.id)
+                self.assertEqual(job.state, 'pending')
+                self.assertEqual(job.attempts, 2)
+
+                # Every attempt failed, the job is given up
+                ImportJob.write([job], {'attempts': 5})
+                ImportJob.save_results([job], [], failures)
+                job = ImportJob(job.id)
+                self.assertEqual(job.state, 'failed')
+                self.assertIsNone(job.next_attempt)
+
+                ImportJob.retry([job])
+                ImportJob.save_results([job], sales, [])
+                job = ImportJob(job.id)
+                self.assertEqual(job.state, 'done')
+                self.assertEqual(job.sale, sales[0])
+
     def test_0020_order_import_from_prestashop(self):
         """Test Order import from prestashop
         """
@@ -155,6 +398,181 @@ class TestSale(BaseTestCase):
                     ('channel', '=', self.channel.id)
                 ])), 1)
 
+                # The import completed, so no checkpoint is left behind
+                channel = self.SaleChannel(self.channel.id)
+                self.assertTrue(channel.last_order_import_time)
+                self.assertIsNone(channel.prestashop_checkpoint_time)
+                self.assertIsNone(channel.prestashop_checkpoint_order_id)
+
+    def test_0022_order_import_locked(self):
+        """Skip the synchronisations of a channel locked by another one
+        """
+        @contextmanager
+        def locked_by_another(channel):
+            yield False
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                prestashop_lock = self.SaleChannel.prestashop_lock
+                self.SaleChannel.prestashop_lock = locked_by_another
+                try:
+                    channel = self.SaleChannel(self.channel.id)
+                    self.assertEqual(channel.import_orders(), [])
+                    self.assertEqual(channel.export_orders_to_prestashop(), [])
+                    self.assertEqual(
+                        channel.process_prestashop_import_jobs(), []
+                    )
+                finally:
+                    self.SaleChannel.prestashop_lock = prestashop_lock
+
+                # Nothing was imported and the last import time is untouched
+                self.assertEqual(len(self.Sale.search([
+                    ('channel', '=', self.channel.id)
+                ])), 0)
+                channel = self.SaleChannel(self.channel.id)
+                self.assertIsNone(channel.last_order_import_time)
+                self.assertIsNone(channel.prestashop_checkpoint_time)
+
+                # The channel is not locked by another synchronisation anymore
+                self.assertEqual(len(channel.import_orders()), 1)
+
+    def test_0025_order_import_in_pages(self):
+        """Import the orders one page at a time, each page starting after the
+        last order of the previous one
+        """
+        from trytond.modules.prestashop import channel as channel_module
+
+        ImportJob = POOL.get('prestashop.import.job')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                self.SaleChannel.write([self.channel], {
+                    'prestashop_import_page_size': 1,
+                })
+
+                client = FakeClient('Some URL', 'A Key')
+                mock_client_class = channel_module.MockstaShopWebservice
+                channel_module.MockstaShopWebservice = lambda url, key: client
+                try:
+                    channel = self.SaleChannel(self.channel.id)
+                    sales = channel.import_orders()
+                finally:
+                    channel_module.MockstaShopWebservice = mock_client_class
+
+                # Every order is imported exactly once
+                self.assertEqual(
+                    sorted(sale.prestashop_id for sale in sales), [1, 3]
+                )
+                self.assertEqual(
+                    sorted(sale.prestashop_id for sale in self.Sale.search([
+                        ('channel', '=', self.channel.id)
+                    ])),
+                    [1, 3]
+                )
+                self.assertEqual(ImportJob.search([]), [])
+
+                # The last page is the first one with less orders than the
+                # page size
+                self.assertEqual(
+                    [request['id'] for request in client.orders.requests], [
+                        '1,%d' % channel_module.MAX_PRESTASHOP_ID,
+                        '2,%d' % channel_module.MAX_PRESTASHOP_ID,
+                        '4,%d' % channel_module.MAX_PRESTASHOP_ID,
+                    ]
+                )
+
+    def test_0027_order_import_resumed(self):
+        """Resume an interrupted order import from its checkpoint
+        """
+        from trytond.modules.prestashop import channel as channel_module
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                last_order_import_time = (
+                    datetime.utcnow() - relativedelta(days=1)
+                ).replace(microsecond=0)
+                self.SaleChannel.write([self.channel], {
+                    'last_order_import_time': last_order_import_time,
+                    'prestashop_import_page_size': 1,
+                    'prestashop_checkpoint_interval': 1,
+                })
+
+                # The connection is lost while fetching the second page
+                client = FakeClient('Some URL', 'A Key')
+                client.orders.failing_request = 2
+                mock_client_class = channel_module.MockstaShopWebservice
+                channel_module.MockstaShopWebservice = lambda url, key: client
+                try:
+                    channel = self.SaleChannel(self.channel.id)
+                    self.assertRaises(Exception, channel.import_orders)
+                finally:
+                    channel_module.MockstaShopWebservice = mock_client_class
+
+                # The first page was saved as the checkpoint
+                channel = self.SaleChannel(self.channel.id)
+                self.assertEqual(channel.prestashop_checkpoint_order_id, 1)
+                self.assertTrue(channel.prestashop_checkpoint_time)
+                self.assertEqual(
+                    channel.last_order_import_time, last_order_import_time
+                )
+                checkpoint_time = channel.prestashop_checkpoint_time
+                first_run_requests = client.orders.requests
+
+                client = FakeClient('Some URL', 'A Key')
+                channel_module.MockstaShopWebservice = lambda url, key: client
+                try:
+                    sales = channel.import_orders()
+                finally:
+                    channel_module.MockstaShopWebservice = mock_client_class
+
+                # The import resumes after the checkpoint, in the time window
+                # of the interrupted import
+                self.assertEqual(
+                    client.orders.requests[0]['id'],
+                    '2,%d' % channel_module.MAX_PRESTASHOP_ID
+                )
+                self.assertEqual(
+                    client.orders.requests[0]['date_upd'],
+                    first_run_requests[0]['date_upd']
+                )
+                self.assertEqual([sale.prestashop_id for sale in sales], [3])
+                self.assertEqual(len(self.Sale.search([
+                    ('channel', '=', self.channel.id)
+                ])), 2)
+
+                # The import completed, the next one starts from the end of
+                # the time window
+                channel = self.SaleChannel(self.channel.id)
+                self.assertEqual(
+                    channel.last_order_import_time, checkpoint_time
+                )
+                self.assertIsNone(channel.prestashop_checkpoint_time)
+                self.assertIsNone(channel.prestashop_checkpoint_order_id)
+
     def test_0030_check_prestashop_exception_order_total(self):
         """
         Check if exception is created when order total does not match
@@ -189,6 +607,212 @@ class TestSale(BaseTestCase):
 
                 self.assertNotEqual(sale.state, 'done')
 
+    def test_0035_export_order_state(self):
+        """Export the state of an order as an entry of its history on PS
+        """
+        from trytond.modules.prestashop import channel as channel_module
+
+        SiteOrderState = POOL.get('prestashop.site.order_state')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order_data = get_objectified_xml('orders', 1)
+                sale = self.Sale.find_or_create_using_ps_data(order_data)
+                self.assertEqual(sale.state, 'done')
+
+                order_state, = SiteOrderState.search([
+                    ('channel', '=', self.channel.id),
+                    ('prestashop_id', '=', 4),
+                ])
+                SiteOrderState.write([order_state], {
+                    'order_state': 'sale.done',
+                })
+
+                client = FakeClient('Some URL', 'A Key')
+                mock_client_class = channel_module.MockstaShopWebservice
+                channel_module.MockstaShopWebservice = lambda url, key: client
+                try:
+                    channel = self.SaleChannel(self.channel.id)
+                    sales = channel.export_orders_to_prestashop()
+                finally:
+                    channel_module.MockstaShopWebservice = mock_client_class
+
+                self.assertEqual(sales, [sale])
+
+                # The new state of the order is added to its history
+                order_history, = client.order_histories.created
+                self.assertEqual(order_history.tag, 'order_history')
+                self.assertEqual(
+                    order_history.findtext('id_order'),
+                    str(order_data.id.pyval)
+                )
+                self.assertEqual(order_history.findtext('id_order_state'), '4')
+
+                # The state is remembered, so it is not exported again
+                sale = self.Sale(sale.id)
+                self.assertEqual(sale.prestashop_current_state, 4)
+                self.assertEqual(
+                    self.Sale.get_prestashop_states_to_export([sale]), []
+                )
+
+    def test_0040_export_order_state_fails(self):
+        """Export the state of an order which cannot be updated on PS
+        """
+        from trytond.modules.prestashop import channel as channel_module
+
+        SiteOrderState = POOL.get('prestashop.site.order_state')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order_data = get_objectified_xml('orders', 1)
+                sale = self.Sale.find_or_create_using_ps_data(order_data)
+                self.assertEqual(sale.state, 'done')
+
+                order_state, = SiteOrderState.search([
+                    ('channel', '=', self.channel.id),
+                    ('prestashop_id', '=', 4),
+                ])
+                SiteOrderState.write([order_state], {
+                    'order_state': 'sale.done',
+                })
+
+                last_order_export_time = (
+                    datetime.utcnow() - relativedelta(hours=1)
+                ).replace(microsecond=0)
+                self.SaleChannel.write([self.channel], {
+                    'last_order_export_time': last_order_export_time,
+                })
+
+                # The mock client cannot update orders, so the export fails
+                channel = self.SaleChannel(self.channel.id)
+                self.assertEqual(channel.export_orders_to_prestashop(), [])
+
+                sale = self.Sale(sale.id)
+                self.assertEqual(
+                    sale.prestashop_current_state,
+                    order_data.current_state.pyval
+                )
+                self.assertRaises(Exception, sale.export_status_to_ps)
+
+                # The export time moves on, but the sale is flagged to be
+                # exported again by the next export, even if it is not
+                # modified again
+                channel = self.SaleChannel(self.channel.id)
+                self.assertTrue(
+                    channel.last_order_export_time > last_order_export_time
+                )
+                self.assertTrue(sale.prestashop_export_failed)
+
+                sale_table = self.Sale.__table__()
+                Transaction().cursor.execute(*sale_table.update(
+                    columns=[sale_table.write_date],
+                    values=[last_order_export_time],
+                    where=sale_table.id == sale.id
+                ))
+                self.assertEqual(
+                    channel.get_prestashop_sale_ids_to_export(), [sale.id]
+                )
+
+                # The flag is cleared once the state is exported
+                client = FakeClient('Some URL', 'A Key')
+                mock_client_class = channel_module.MockstaShopWebservice
+                channel_module.MockstaShopWebservice = lambda url, key: client
+                try:
+                    channel = self.SaleChannel(self.channel.id)
+                    self.assertEqual(
+                        channel.export_orders_to_prestashop(), [sale]
+                    )
+                finally:
+                    channel_module.MockstaShopWebservice = mock_client_class
+
+                sale = self.Sale(sale.id)
+                self.assertFalse(sale.prestashop_export_failed)
+                self.assertEqual(sale.prestashop_current_state, 4)
+
+    def test_0045_sales_to_export_with_moved_shipment(self):
+        """Find the sales to export whose outgoing shipment changed since the
+        last export, though the sales themselves did not
+        """
+        Move = POOL.get('stock.move')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                # An order in preparation is processed with its shipment
+                order_data = get_objectified_xml('orders', 1)
+                order_data.current_state = 3
+                sale = self.Sale.find_or_create_using_ps_data(order_data)
+                self.assertEqual(sale.state, 'processing')
+
+                # The sale is due for export as nothing was exported yet
+                self.assertEqual(
+                    self.channel.get_prestashop_sale_ids_to_export(),
+                    [sale.id]
+                )
+
+                # The orders are exported just before a move of the shipment
+                # is written, long after the sale was
+                shipment, = sale.shipments
+                move = shipment.outgoing_moves[0]
+                Move.write([move], {'quantity': move.quantity})
+                move = Move(move.id)
+                export_time = move.write_date - relativedelta(seconds=1)
+
+                sale_table = self.Sale.__table__()
+                Transaction().cursor.execute(*sale_table.update(
+                    columns=[sale_table.write_date],
+                    values=[export_time - relativedelta(hours=1)],
+                    where=sale_table.id == sale.id
+                ))
+                self.SaleChannel.write([self.channel], {
+                    'last_order_export_time': export_time,
+                })
+
+                # The sale is found through its move only
+                sale = self.Sale(sale.id)
+                channel = self.SaleChannel(self.channel.id)
+                self.assertTrue(
+                    sale.write_date < channel.last_order_export_time
+                )
+                self.assertEqual(
+                    channel.get_prestashop_sale_ids_to_export(), [sale.id]
+                )
+
+                # Nothing is due once the move was not written since the
+                # last export either
+                self.SaleChannel.write([self.channel], {
+                    'last_order_export_time': (
+                        move.write_date + relativedelta(seconds=1)
+                    ),
+                })
+                channel = self.SaleChannel(self.channel.id)
+                self.assertEqual(
+                    channel.get_prestashop_sale_ids_to_export(), []
+                )
+
 
 def suite():
     "Prestashop Sale test suite"
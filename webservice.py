@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+"""
+    webservice
+
+    Helpers to talk to the prestashop webservice efficiently.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import requests
+import pystashop
+import pystashop.api
+from lxml import etree, objectify
+from requests.adapters import HTTPAdapter
+
+
+__all__ = [
+    'RecordCache', 'using_record_cache', 'get_record_cache', 'get_client',
+    'get_session', 'format_display', 'map_concurrently', 'get_read_client',
+    'PooledPrestaShopWebservice', 'ReadWebservice', 'XMLWebservice',
+    'JSONWebservice', 'JSONRecord', 'JSONValue',
+]
+
+_local = threading.local()
+
+#: Number of connections kept alive per prestashop site
+POOL_SIZE = 10
+
+_registry_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_read_clients = {}
+
+
+def get_session(url, key):
+    """Return the HTTP session shared by every client of the prestashop site
+    with the given URL and key. The session keeps a pool of keep-alive
+    connections, so that the TCP and TLS handshakes are done once per
+    connection rather than once per request.
+
+    :param url: URL of the prestashop site
+    :param key: Webservice key of the prestashop site
+    :returns: `requests.Session` instance
+    """
+    with _registry_lock:
+        session = _sessions.get((url, key))
+        if session is None:
+            session = requests.Session()
+            session.auth = (key, '')
+            adapter = HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[(url, key)] = session
+        return session
+
+
+class PooledPrestaShopWebservice(pystashop.PrestaShopWebservice):
+    """The pystashop client, sending its requests through the given session
+    instead of a session of its own.
+
+    :param url: URL of the prestashop site
+    :param key: Webservice key of the prestashop site
+    :param session: `requests.Session` with the credentials of the site
+    """
+
+    def __init__(self, url, key, session, debug=False):
+        super(PooledPrestaShopWebservice, self).__init__(url, key, debug)
+        self.pooled_session = session
+
+    @property
+    def session(self):
+        return self.pooled_session
+
+
+def get_client(channel_id, url, key):
+    """Return the prestashop client of the channel. The client is created
+    once per channel, URL and key and reused afterwards, along with the
+    pooled HTTP session of the site.
+
+    :param channel_id: ID of the sale channel
+    :param url: URL of the prestashop site
+    :param key: Webservice key of the prestashop site
+    :returns: `PooledPrestaShopWebservice` instance
+    """
+    session = get_session(url, key)
+    with _registry_lock:
+        client = _clients.get((channel_id, url, key))
+        if client is None:
+            client = PooledPrestaShopWebservice(url, key, session)
+            _clients[(channel_id, url, key)] = client
+        return client
+
+
+def get_read_client(channel_id, url, key, output_format='xml'):
+    """Return the client of the channel which reads the records imported
+    from the prestashop site, in the given output format. The client is
+    created once per channel, URL, key and format and reused afterwards.
+
+    :param channel_id: ID of the sale channel
+    :param url: URL of the prestashop site
+    :param key: Webservice key of the prestashop site
+    :param output_format: `xml` or `json`
+    :returns: `ReadWebservice` instance
+    """
+    session = get_session(url, key)
+    with _registry_lock:
+        client = _read_clients.get((channel_id, url, key, output_format))
+        if client is None:
+            client_class = {
+                'xml': XMLWebservice,
+                'json': JSONWebservice,
+            }[output_format]
+            client = client_class(url, session)
+            _read_clients[(channel_id, url, key, output_format)] = client
+        return client
+
+
+def map_concurrently(func, items, max_workers=1):
+    """Call the function with each of the items in a pool of at most
+    `max_workers` threads and return the results in the order of the items.
+    The function must not touch tryton as it runs outside the transaction.
+
+    :param func: Function to be called with each item
+    :param items: List of items
+    :param max_workers: Maximum number of threads used
+    :returns: List of results
+    """
+    workers = min(max_workers, len(items))
+    if workers <= 1:
+        return map(func, items)
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def format_display(fields):
+    """Return the `display` argument of `get_list` which restricts the
+    records sent to the given fields. Every field is sent if no field is
+    given.
+
+    :param fields: List of the names of the fields, eg: `['id', 'email']`
+    :returns: The list of fields or `full`
+    """
+    if not fields:
+        return 'full'
+    return list(fields)
+
+
+class RecordCache(object):
+    """In-memory store of prestashop records fetched in bulk
+
+    Importing an order needs the customer, the addresses and the order details
+    of the order. Instead of fetching them one by one for every order, the ids
+    for a whole page of orders are collected and the records are fetched with
+    a single `filter[id]=[a|b|c]` request per resource. The per order code
+    then reads the records from this store.
+
+    Only the fields given in `display` for a resource are requested, every
+    field is requested for the other resources.
+    """
+
+    #: Number of ids sent in a single request, to keep the URL length sane
+    chunk_size = 100
+
+    def __init__(
+        self, channel_id, client, max_workers=1, order_states=None,
+        display=None
+    ):
+        self.channel_id = channel_id
+        self.client = client
+        self.max_workers = max_workers
+        self.records = defaultdict(dict)
+
+        #: The fields to be requested by resource name
+        self.display = display or {}
+
+        #: The order states of the channel by prestashop id. These are loaded
+        #: once per import and shared by the caches of all the pages.
+        self.order_states = order_states
+
+    def prefetch(self, resource, ids):
+        """Fetch the records of the resource with the given ids which are
+        not in the store yet.
+
+        :param resource: Name of the prestashop resource, eg: `customers`
+        :param ids: Iterable of prestashop ids
+        """
+        self.prefetch_many({resource: ids})
+
+    def prefetch_many(self, ids_by_resource):
+        """Fetch the records of several resources which are not in the store
+        yet. The requests are independent of each other, so they are sent
+        concurrently by a pool of at most `max_workers` threads. The records
+        are only added to the store by the calling thread.
+
+        :param ids_by_resource: Dictionary of resource name and the
+                                iterable of prestashop ids to be fetched
+        """
+        requests_to_send = []
+        for resource, ids in ids_by_resource.iteritems():
+            ids = sorted(
+                set(filter(None, ids)) - set(self.records[resource].keys())
+            )
+            for index in xrange(0, len(ids), self.chunk_size):
+                requests_to_send.append(
+                    (resource, ids[index:index + self.chunk_size])
+                )
+
+        results = map_concurrently(
+            self._fetch, requests_to_send, self.max_workers
+        )
+        for (resource, ids), records in zip(requests_to_send, results):
+            for record in records:
+                self.records[resource][record.id.pyval] = record
+
+    def _fetch(self, request):
+        """Fetch the records for a single (resource, ids) request. This is
+        run in the worker threads and must not touch the store or tryton.
+        """
+        resource, ids = request
+        return getattr(self.client, resource).get_list(
+            filters={'id': '|'.join(map(str, ids))},
+            display=format_display(self.display.get(resource)),
+        )
+
+    def get(self, resource, record_id):
+        """Return the record of the resource with the given id. If the record
+        was not prefetched, it is fetched from prestashop.
+
+        :param resource: Name of the prestashop resource, eg: `customers`
+        :param record_id: Prestashop id of the record
+        :returns: Objectified XML record
+        """
+        record = self.records[resource].get(record_id)
+        if record is None and self.display.get(resource):
+            # Only a list request can restrict the fields sent
+            self.prefetch(resource, [record_id])
+            record = self.records[resource].get(record_id)
+        if record is None:
+            record = getattr(self.client, resource).get(record_id)
+            self.records[resource][record_id] = record
+        return record
+
+
+@contextmanager
+def using_record_cache(cache):
+    """Make the record cache given the current one for this thread within the
+    block.
+
+    The cache is kept thread local, the same way tryton keeps the transaction,
+    instead of the transaction context since context values end up in the
+    keys of tryton caches and would keep the records alive.
+
+    :param cache: Instance of `RecordCache`
+    """
+    previous = getattr(_local, 'record_cache', None)
+    _local.record_cache = cache
+    try:
+        yield cache
+    finally:
+        _local.record_cache = previous
+
+
+def get_record_cache():
+    """Return the record cache current for this thread, if any
+    """
+    return getattr(_local, 'record_cache', None)
+
+
+def _to_pyval(value):
+    """Convert a value sent in JSON to the python value lxml objectify would
+    give for the same value sent in XML, as everything is sent as text.
+    """
+    if value is None:
+        return ''
+    if not isinstance(value, basestring):
+        return value
+    for type_ in (int, float):
+        try:
+            return type_(value)
+        except ValueError:
+            pass
+    if value in ('true', 'false'):
+        return value == 'true'
+    return value
+
+
+def _wrap(value):
+    """Wrap a JSON value in the record class behaving as the objectified
+    element of the same value would.
+    """
+    if isinstance(value, dict):
+        if set(value.keys()) == set(['id', 'value']):
+            # A value in a language, eg: the name of a product
+            return JSONValue(value['value'], {'id': unicode(value['id'])})
+        return JSONRecord(value)
+    if isinstance(value, list):
+        return JSONRecord(dict(enumerate(value)))
+    return JSONValue(value)
+
+
+class JSONValue(object):
+    """A single value of a record sent in the JSON output format. It behaves
+    as the objectified XML element of the value in the ways used by the
+    `*_using_ps_data` methods.
+    """
+
+    def __init__(self, value, attrib=None):
+        self.value = value
+        self.attrib = attrib or {}
+
+    @property
+    def pyval(self):
+        return _to_pyval(self.value)
+
+    def get(self, key, default=None):
+        """Return the attribute of the value, eg: `id` of the language
+        """
+        return self.attrib.get(key, default)
+
+    def __nonzero__(self):
+        return bool(self.pyval)
+
+    __bool__ = __nonzero__
+
+    def __unicode__(self):
+        return u'' if self.value is None else unicode(self.value)
+
+    def __str__(self):
+        return '' if self.value is None else str(self.value)
+
+
+class JSONRecord(object):
+    """A record, or a list of records, sent in the JSON output format. The
+    fields are available as attributes and the items of a list as children,
+    like on an objectified XML element.
+
+    The records are kept as the plain dictionaries decoded from JSON and are
+    wrapped only when a field is read, which makes them far lighter than an
+    objectified tree.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getattr__(self, name):
+        try:
+            return _wrap(self.__dict__['data'][name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def getchildren(self):
+        return [_wrap(self.data[key]) for key in sorted(self.data.keys())]
+
+    def iterchildren(self):
+        return iter(self.getchildren())
+
+    def __nonzero__(self):
+        return True
+
+    __bool__ = __nonzero__
+
+
+class ResourceProxy(object):
+    """Proxy for a resource of the webservice, with the `get` and `get_list`
+    methods of the pystashop client.
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def get(self, resource_id):
+        """Return the record of the resource with the given id
+        """
+        return self.client.get_record(self.name, resource_id)
+
+    def get_list(
+        self, display=None, filters=None, sort=None, limit=None, offset=None,
+        date=None
+    ):
+        """Return the list of records of the resource. The arguments are the
+        same as the ones of the pystashop client.
+        """
+        return list(
+            self.iter_list(display, filters, sort, limit, offset, date)
+        )
+
+    def iter_list(
+        self, display=None, filters=None, sort=None, limit=None, offset=None,
+        date=None
+    ):
+        """Same as `get_list`, but the records are yielded one at a time as
+        they are read from the response.
+        """
+        params = pystashop.api.ResourceProxy.make_params(
+            display, filters, sort, limit, offset, date
+        )
+        return self.client.iter_records(self.name, params)
+
+
+class ReadWebservice(object):
+    """Base of the clients of the prestashop webservice used to read the
+    records imported. Only reading records is supported.
+
+    The clients implement `get_record(resource, resource_id)`, which returns
+    the record of the resource with the given id, and
+    `iter_records(resource, params)`, which yields the records of the
+    resource sent for the given parameters.
+
+    :param url: URL of the prestashop site
+    :param session: `requests.Session` with the credentials of the site
+    """
+
+    def __init__(self, url, session):
+        self.url = url.rstrip('/') + '/api/'
+        self.session = session
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return ResourceProxy(self, name)
+
+
+class XMLWebservice(ReadWebservice):
+    """Client of the prestashop webservice which reads the records in XML
+    and returns them as objectified elements, like the pystashop client.
+
+    A list is parsed as the response is received instead of once the whole
+    response is in memory. Each record is detached from the tree as soon as
+    it is complete, so that neither the response body nor a tree of the
+    whole list is kept.
+    """
+
+    #: Number of bytes of the response body parsed at a time
+    chunk_size = 64 * 1024
+
+    def _get_parser(self, **kwargs):
+        parser = etree.XMLPullParser(remove_blank_text=True, **kwargs)
+        parser.set_element_class_lookup(
+            objectify.ObjectifyElementClassLookup()
+        )
+        return parser
+
+    def get_record(self, resource, resource_id):
+        response = self.session.get(
+            self.url + '%s/%s' % (resource, resource_id)
+        )
+        response.raise_for_status()
+        # The record is the only child of the root element
+        return objectify.fromstring(response.content).getchildren()[0]
+
+    def iter_records(self, resource, params):
+        response = self.session.get(
+            self.url + resource, params=params, stream=True
+        )
+        try:
+            response.raise_for_status()
+            parser = self._get_parser(events=('start', 'end'))
+            depth = 0
+            for chunk in response.iter_content(self.chunk_size):
+                parser.feed(chunk)
+                records, depth = self._read_records(parser, depth)
+                for record in records:
+                    yield record
+            parser.close()
+        finally:
+            response.close()
+
+    def _read_records(self, parser, depth):
+        """Read the pending events of the parser and return the records
+        completed along with the depth reached.
+
+        objectify picks the class of an element, eg: `IntElement`, when its
+        python proxy is created, which happens for an event before the text
+        of the element is parsed. The records are only returned once all the
+        events are read and their proxies released, so that the fields of
+        the records get new proxies of the right class.
+        """
+        records = []
+        # The records are the elements at depth 3 of
+        # <prestashop><orders><order>
+        for event, element in parser.read_events():
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 2:
+                element.getparent().remove(element)
+                records.append(element)
+        return records, depth
+
+
+class JSONWebservice(ReadWebservice):
+    """Client of the prestashop webservice which asks for the JSON output
+    format and returns the records as `JSONRecord` instances.
+    """
+
+    def request(self, path, params):
+        """Send a GET request to the webservice and return the decoded JSON
+        """
+        params = dict(params, output_format='JSON')
+        response = self.session.get(self.url + path, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def get_record(self, resource, resource_id):
+        data = self.request('%s/%s' % (resource, resource_id), {})
+        record, = data.values()
+        return JSONRecord(record)
+
+    def iter_records(self, resource, params):
+        data = self.request(resource, params)
+        # An empty list is sent instead of an object when nothing matches
+        if not data:
+            return iter([])
+        return (JSONRecord(record) for record in data[resource])